@@ -1,6 +1,7 @@
 # python audit.py /Users/jar/otrepo/files.opentreeoflife.org /Users/jar question: varela:/home/opentree/files.opentreeoflife.org/
 
 import argparse
+import transfer
 p = argparse.ArgumentParser()
 # The default= clauses seem to have no effet
 p.add_argument("repo",
@@ -19,6 +20,26 @@ p.add_argument("resources",
                default='var/recap/initial_resources.json')
 p.add_argument("captures",
                default='var/recap/initial_captures.json')
+p.add_argument("--jobs", type=int, default=16,
+               help="number of threads for the filesystem stat pass")
+p.add_argument("--verify", action='store_true',
+               help="check SHA-256 digests of capture files (slow: reads every file)")
+p.add_argument("--manifest",
+               help="where to record digests, default audit_manifest.json next to captures")
+p.add_argument("--rehash", action='store_true',
+               help="with --verify, hash even files that are unchanged since the last audit")
+p.add_argument("--probe", action='store_true',
+               help="check http(s) locations with HEAD requests before using them")
+p.add_argument("--stats",
+               help="per-host transfer statistics used to choose locations, default transfer_stats.json next to captures")
+p.add_argument("--execute", action='store_true',
+               help="run the fix-up commands instead of printing them")
+p.add_argument("--transfers", type=int, default=transfer.default_transfers,
+               help="with --execute, how many fix-ups to run at once")
+p.add_argument("--per-host", type=int, default=transfer.default_per_host,
+               help="with --execute, how many transfers to run at once from any one host")
+p.add_argument("--retries", type=int, default=transfer.default_retries,
+               help="with --execute, how many times to retry a failing command")
 
 # os.path.realpath(symlink)
 
@@ -40,29 +61,244 @@ p.add_argument("captures",
 #       ...
 #     ...
 
-import os
-import registry
+import os, sys, stat, json
+from multiprocessing.pool import ThreadPool
+import registry, digest, fileutil, probe, sources, dedup
 
 # shuffle bits around to get local artifact store into shape
 
-def audit(the_registry, repo, prefix, local, files_prefix):
-    commands = []
+# With an executor, runs the fix-up commands and returns the ones
+# that failed; otherwise prints them, as a shell script.
+
+def audit(the_registry, repo, prefix, local, files_prefix, jobs=16, verifier=None,
+          executor=None, probes=None, source_stats=None):
+    pairs = []
     for rmeta in the_registry.all_resources():
-        did = False
         for cmeta in the_registry.all_captures(rmeta['name']):
-            a = audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix)
-            if len(a) > 0:
-                if not did:
-                    commands.extend(audit_resource(rmeta, repo))
-                    did = True
-                commands.extend(a)
+            pairs.append((cmeta, rmeta))
+
+    # Stat everything up front, in parallel (slow filesystems, e.g.
+    # NFS, are mostly latency), then report in the usual order.
+    paths = []
+    for (cmeta, rmeta) in pairs:
+        paths.append(os.path.join(repo, rmeta['name']))
+        paths.append(os.path.join(repo, registry.get_capture_path(cmeta, rmeta)))
+    stats = stat_all(paths, jobs)
+
+    if verifier != None:
+        # Hash the files that pass the quick audit, in parallel
+        candidates = []
+        for (cmeta, rmeta) in pairs:
+            otpath = registry.get_capture_path(cmeta, rmeta)
+            dst = os.path.join(repo, otpath)
+            st = stats[dst]
+            if (cmeta.get('_archivable') != False and st.exists() and
+                not st.islink() and not st.isdir() and
+                cmeta.get('bytes', st.size()) == st.size()):
+                candidates.append((dst, otpath, st))
+        verifier.hash(candidates)
+
+    commands = []
+    prep = []                   # commands for resources
+    fixups = []                 # commands for captures
+    did = {}
+    for (cmeta, rmeta) in pairs:
+        (a, loc) = audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix, stats,
+                                 verifier, probes, source_stats)
+        if len(a) > 0:
+            if not rmeta['name'] in did:
+                r = audit_resource(rmeta, repo, stats)
+                commands.extend(r)
+                prep.extend(r)
+                did[rmeta['name']] = True
+            commands.extend(a)
+            dst = os.path.join(repo, registry.get_capture_path(cmeta, rmeta))
+            source = None
+            if loc != None:
+                source = sources.location_key(loc, prefix)
+            fixups.append(transfer.Fixup(cmeta['name'], a, dst, loc, source))
+    if verifier != None:
+        verifier.save()
+    if executor != None:
+        return executor.execute(fixups, prep)
     print 'set -e'
     for command in commands:
         print command
 
-def audit_resource(rmeta, repo):
+# HEAD every http(s) location of every capture, all at once.  Returns
+# dict url -> probe.Probe.  Response times go into source_stats, along
+# with failures: against the host if it couldn't be reached, otherwise
+# (e.g. 404) against the one location.
+
+def probe_locations(pairs, source_stats=None):
+    urls = []
+    for (cmeta, rmeta) in pairs:
+        if cmeta.get('_archivable') == False: continue
+        for loc in cmeta.get('locations', []):
+            if loc.startswith('http://') or loc.startswith('https://'):
+                urls.append(loc)
+    print 'probing', len(urls), 'locations'
+    probes = probe.probe_urls(urls)
+    if source_stats != None:
+        for url in urls:
+            host = sources.location_key(url, None)
+            found = probes[url]
+            if found.unreachable:
+                source_stats.record_failure(host)
+                continue
+            if found.seconds != None:
+                source_stats.record_latency(host, found.seconds)
+            if found.ok():
+                source_stats.record_location_ok(host, url)
+            else:
+                source_stats.record_location_failure(host, url)
+        source_stats.save()
+    return probes
+
+# One lstat per path, plus a stat if it's a symbolic link, so that
+# exists / islink / isdir / size don't each cost a system call.
+
+class PathStat:
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.lstat = os.lstat(path)
+        except OSError:
+            self.lstat = None
+        self.stat = self.lstat
+        if self.islink():
+            try:
+                self.stat = os.stat(path)
+            except OSError:
+                self.stat = None    # broken link
+    def exists(self):
+        return self.stat != None
+    def lexists(self):
+        return self.lstat != None
+    def islink(self):
+        return self.lstat != None and stat.S_ISLNK(self.lstat.st_mode)
+    def isdir(self):
+        return self.stat != None and stat.S_ISDIR(self.stat.st_mode)
+    def size(self):
+        return self.stat.st_size
+
+# Returns dict path -> PathStat, stats done by a pool of threads
+
+def stat_all(paths, jobs=16):
+    unique = []
+    seen = {}
+    for path in paths:
+        if not path in seen:
+            seen[path] = True
+            unique.append(path)
+    if jobs > 1 and len(unique) > 1:
+        pool = ThreadPool(min(jobs, len(unique)))
+        try:
+            results = pool.map(PathStat, unique)
+        finally:
+            pool.close()
+    else:
+        results = map(PathStat, unique)
+    return dict(zip(unique, results))
+
+# --verify: compare the SHA-256 of each capture file with the digest
+# registered for it, or failing that with the one recorded by the last
+# verifying audit; record it if there's neither.  Recorded digests go
+# in a manifest (JSON, keyed by path relative to the repo) along with
+# the size, mtime and inode the file had when it was hashed.  A file
+# whose stat still matches isn't hashed again (unless rehash), so
+# re-auditing a mostly static archive only reads what changed.
+
+class Verifier:
+    def __init__(self, manifest_path, jobs=None, rehash=False):
+        self.manifest_path = manifest_path
+        self.manifest = load_manifest(manifest_path)
+        self.jobs = jobs        # processes; None means one per core
+        self.rehash = rehash
+        self.digests = {}       # absolute path -> hex digest
+        self.stats = {}         # absolute path -> PathStat
+        self.recorded = 0
+    # files is a list of (absolute path, repo-relative path, PathStat)
+    # Files that are hard links to one blob (see dedup.py) are hashed once.
+    def hash(self, files):
+        to_hash = []
+        links = {}              # (dev, ino) -> absolute paths
+        for (dst, otpath, st) in files:
+            self.stats[dst] = st
+            entry = self.manifest.get(otpath)
+            if (not self.rehash and entry != None and 'sha256' in entry and
+                stat_fields(entry) == stat_fields(st.stat)):
+                self.digests[dst] = entry['sha256']
+            else:
+                key = (st.stat.st_dev, st.stat.st_ino)
+                if not key in links:
+                    links[key] = []
+                    to_hash.append(dst)
+                links[key].append(dst)
+        shared = sum([len(paths) - 1 for paths in links.values()])
+        print 'hashing', len(to_hash), 'files,', len(files) - len(to_hash) - shared, 'unchanged since last audit'
+        if shared > 0:
+            print shared, 'more are hard links to files being hashed'
+        digests = digest.hash_files(to_hash, self.jobs)
+        for paths in links.values():
+            if paths[0] in digests:
+                for dst in paths:
+                    self.digests[dst] = digests[paths[0]]
+    def check(self, cmeta, dst, otpath):
+        have = self.digests.get(dst)
+        if have == None:
+            # Couldn't be read (error already reported), so can't be trusted
+            print '** exists but could not be read to check its digest', dst
+            return False
+        entry = self.manifest.get(otpath, {})
+        want = cmeta.get('sha256')
+        if want != None:
+            if have != want:
+                print '** exists but digest is wrong', dst, want, have
+                return False
+        elif entry.get('sha256') not in (None, have):
+            print '** digest changed since it was recorded', dst, entry['sha256'], have
+            return False
+        new = stat_fields(self.stats[dst].stat)
+        new['sha256'] = have
+        if entry != new:
+            self.manifest[otpath] = new
+            self.recorded += 1
+        return True
+    def save(self):
+        if self.recorded > 0:
+            print 'recorded', self.recorded, 'files in', self.manifest_path
+            save_manifest(self.manifest, self.manifest_path)
+
+# The parts of a stat (or manifest entry) that say whether a file
+# might have changed
+
+def stat_fields(st):
+    if isinstance(st, dict):
+        return {'size': st.get('size'), 'mtime': st.get('mtime'), 'ino': st.get('ino')}
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'ino': st.st_ino}
+
+def load_manifest(path):
+    if os.path.exists(path):
+        with open(path) as infile:
+            return json.load(infile)
+    return {}
+
+def save_manifest(manifest, path):
+    with fileutil.atomic_write(path) as outfile:
+        json.dump(manifest, outfile, indent=1, sort_keys=True)
+
+def default_manifest_path(captures_path):
+    return os.path.join(os.path.dirname(captures_path), 'audit_manifest.json')
+
+def get_stat(path, stats):
+    if stats != None and path in stats:
+        return stats[path]
+    return PathStat(path)
+
+def audit_resource(rmeta, repo, stats=None):
     resource_dir = os.path.join(repo, rmeta['name'])
-    if os.path.isdir(resource_dir):
+    if get_stat(resource_dir, stats).isdir():
         print rmeta['name'], 'OK'
         return []
     else:
@@ -70,41 +306,76 @@ def audit_resource(rmeta, repo):
 
 # Returns list of strings for commands needed to fix things
 
-def quick_audit_capture(cmeta, rmeta, repo):
+def quick_audit_capture(cmeta, rmeta, repo, stats=None, verifier=None):
 
     # otpath is relative to local repo clone.
     otpath = registry.get_capture_path(cmeta, rmeta)
     dst = os.path.join(repo, otpath)
-    if os.path.exists(dst):
-        if os.path.islink(dst):
+    st = get_stat(dst, stats)
+    if st.exists():
+        if st.islink():
             print '** expected a file but found symlink', dst
             return False
-        elif os.path.isdir(dst):
+        elif st.isdir():
             print '** expected a file but found directory', dst
             return False
         elif 'bytes' in cmeta:
-            have = os.stat(dst).st_size
+            have = st.size()
             want = cmeta['bytes']
             if have == want:
                 # print 'file sizes match - good', dst, want, have
-                return True
+                return verifier == None or verifier.check(cmeta, dst, otpath)
             else:
                 print '** exists but size is wrong', dst, want, have
                 return False
         else:
             print 'exists and might be OK', dst
-            return True
+            return verifier == None or verifier.check(cmeta, dst, otpath)
     else:
         print '** does not exist:', dst
         return False
 
-def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
+# A blob can go bad like any other file, and linking it would pass
+# that on to the capture.  Its size is checked always, its digest with
+# --verify (the manifest keeps it from being hashed at every audit).
+
+def blob_ok(cmeta, bpath, repo, verifier=None):
+    if 'bytes' in cmeta and os.path.getsize(bpath) != cmeta['bytes']:
+        print '** blob has wrong size', bpath, cmeta['bytes'], os.path.getsize(bpath)
+        return False
+    if verifier != None:
+        botpath = os.path.relpath(bpath, repo)
+        verifier.hash([(bpath, botpath, PathStat(bpath))])
+        return verifier.check(cmeta, bpath, botpath)
+    return True
+
+# The commands may be run from any directory, and 'python' on the PATH
+# may not be this one, so scripts are named absolutely
+
+def script_command(script):
+    return '%s %s' % (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script))
+
+# fetch.py resumes an interrupted download from its .tmp file, and
+# checks size and digest before moving it into place
+
+def fetch_command(loc, dst, cmeta):
+    checks = ''
+    if 'bytes' in cmeta:
+        checks += ' --bytes %s' % cmeta['bytes']
+    if 'sha256' in cmeta:
+        checks += ' --sha256 %s' % cmeta['sha256']
+    return '%s%s "%s" %s' % (script_command('fetch.py'), checks, loc, dst)
+
+# Returns (commands, the location they get the capture from or None)
+
+def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix, stats=None,
+                  verifier=None, probes=None, source_stats=None):
 
-    if cmeta.get('_archivable') == False: return []
+    if cmeta.get('_archivable') == False: return ([], None)
 
-    if quick_audit_capture(cmeta, rmeta, repo):
+    if quick_audit_capture(cmeta, rmeta, repo, stats, verifier):
         # OK, nothing to be done.
-        return []
+        return ([], None)
 
     # Need to copy it from one of the source locations
 
@@ -121,19 +392,12 @@ def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
             # on the interwebs
             return None
 
-    def location_sort_order(loc):
-        if '://' in loc:
-            return 2            # access using curl
-        elif ':' in loc:
-            if loc.startswith(local):
-                return 1        # local file
-            else:
-                return 3        # access using ssh
-        else:
-            return 0            # local file name
-
+    # Cheapest (by measured speed of past transfers) first.  With no
+    # history: repo, local file, http (fetch.py), ssh.
+    if source_stats == None:
+        source_stats = sources.SourceStats(None)
     if "locations" in cmeta:
-        locations = sorted(cmeta["locations"], key=location_sort_order)
+        locations = source_stats.order(cmeta["locations"], cmeta, prefix)
     else:
         locations = []
 
@@ -165,7 +429,7 @@ def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
                 if lpath.endswith('/') and dst.endswith('.tgz'):
                     dir = lpath[0:-1]
                     # create tarball, contents = files in path
-                    tbd = "./make-tarball %s %s" % (dir, dst)
+                    tbd = "%s %s %s" % (script_command('tarball.py'), dir, dst)
                 else:
                     print '** source file is a directory, but no /, so not making tarball', lpath
 
@@ -178,8 +442,15 @@ def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
         else:
             # Remote via ssh or http
             if '://' in loc:
-                # print 'curl -s -I "%s" | (if ! grep -q 200.OK; then echo Not found: "%s"; fi)' % (loc, loc)
-                tbd = 'curl -s "%s" >%s.tmp && mv %s.tmp %s' % (loc, dst, dst, dst)
+                if probes != None and loc in probes:
+                    found = probes[loc]
+                    if not found.ok():
+                        print '** location not available:', loc, found.describe()
+                        return None
+                    if 'bytes' in cmeta and found.length != None and found.length != cmeta['bytes']:
+                        print '** location has wrong size:', loc, cmeta['bytes'], found.length
+                        return None
+                tbd = fetch_command(loc, dst, cmeta)
             elif ':' in loc:
                 # print "if ! ssh %s test -r %s; then echo Not found: %s; fi" % (loc[0:i], loc[i+1:], loc)
                 if prefix != 'files:':
@@ -190,14 +461,21 @@ def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
 
     # Only one command per capture.  Throw away all but the first.
     command = None
+    source = None
+    # Same contents already in the blob area (see dedup.py)?
+    if 'sha256' in cmeta:
+        bpath = dedup.blob_path(repo, cmeta['sha256'])
+        if os.path.isfile(bpath) and blob_ok(cmeta, bpath, repo, verifier):
+            command = "ln -f %s %s" % (bpath, dst)
     for loc in locations:
         maybe_command = try_location(loc)
         if maybe_command != None and command == None:
             command = maybe_command
+            source = loc
 
     if command == None:
         print '** no candidate locations for this capture:', cmeta['name']
-        return []
+        return ([], None)
 
     commands = []
 
@@ -206,10 +484,29 @@ def audit_capture(cmeta, rmeta, repo, prefix, local, files_prefix):
         commands.append("mkdir -p %s" % dir)
 
     commands.append(command)
-    return commands
-
+    return (commands, source)
 
-args = p.parse_args()
 
 if __name__ == '__main__':
-    audit(registry.Registry(args.resources, args.captures), args.repo, args.prefix, args.base, args.files)
+    args = p.parse_args()
+    verifier = None
+    if args.verify:
+        verifier = Verifier(args.manifest or default_manifest_path(args.captures),
+                            rehash=args.rehash)
+    source_stats = sources.SourceStats(args.stats or
+                                       os.path.join(os.path.dirname(args.captures),
+                                                    sources.default_stats_name))
+    executor = None
+    if args.execute:
+        executor = transfer.Executor(args.transfers, args.per_host, args.retries,
+                                     stats=source_stats)
+    the_registry = registry.Registry(args.resources, args.captures)
+    probes = None
+    if args.probe:
+        probes = probe_locations([(cmeta, None) for cmeta in the_registry.all_captures()],
+                                 source_stats)
+    failed = audit(the_registry, args.repo, args.prefix, args.base, args.files,
+                   jobs=args.jobs, verifier=verifier, executor=executor, probes=probes,
+                   source_stats=source_stats)
+    if failed:
+        sys.exit(1)
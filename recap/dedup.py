@@ -0,0 +1,145 @@
+# Storing identical capture files only once.
+
+# The same file is sometimes registered as several captures (e.g. a
+# resource that didn't change between two snapshots), and each capture
+# has its own copy at resource/capture/filename.  dedup finds them:
+# files are grouped by size, and only sizes shared by two or more
+# files are hashed (one hash per inode, files in parallel).  Each set
+# of identical files is then stored once, in a content-addressed area
+# of the repo,
+#   .blobs/sha256/<first 2 hex digits>/<rest of digest>
+# and every capture path becomes a hard link to the blob.  Capture
+# paths stay where they were, so nothing that reads the repo has to
+# know about the blobs.  Relinking is atomic (link to a temporary
+# name, then rename over the capture path).
+
+# With --all, every capture file is linked into the blob area, not just
+# duplicates, so that a copy added later can be linked to it.
+
+# python dedup.py repo resources.json captures.json [--dry-run] [--all]
+
+import os, sys, stat, argparse
+import registry, digest, fileutil, transfer
+
+blobs_dir = '.blobs'
+
+def blob_path(repo, sha256):
+    return os.path.join(repo, blobs_dir, 'sha256', sha256[0:2], sha256[2:])
+
+# Returns (bytes reclaimed, number of files relinked)
+
+def dedup(the_registry, repo, jobs=None, dry_run=False, store_all=False):
+    # Capture files by inode, so that files that are already hard links
+    # to one another count once
+    inodes = {}                 # (dev, ino) -> [path, ...]
+    sizes = {}                  # (dev, ino) -> size
+    cmetas = {}                 # path -> cmeta
+    for rmeta in the_registry.all_resources():
+        for cmeta in the_registry.all_captures(rmeta['name']):
+            if cmeta.get('_archivable') == False: continue
+            path = os.path.join(repo, registry.get_capture_path(cmeta, rmeta))
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue        # audit's problem
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            key = (st.st_dev, st.st_ino)
+            inodes.setdefault(key, []).append(path)
+            sizes[key] = st.st_size
+            cmetas[path] = cmeta
+
+    # Only files whose size is shared can have a duplicate
+    by_size = {}
+    for key in inodes:
+        by_size.setdefault(sizes[key], []).append(key)
+    candidates = []
+    for keys in by_size.values():
+        if len(keys) > 1 or store_all:
+            candidates.extend(keys)
+    print len(inodes), 'capture files,', len(candidates), 'to hash'
+    digests = digest.hash_files([inodes[key][0] for key in candidates], jobs)
+
+    by_digest = {}
+    for key in candidates:
+        paths = inodes[key]
+        d = digests.get(paths[0])
+        if d == None:
+            continue            # unreadable, already reported
+        wrong = [path for path in paths if cmetas[path].get('sha256') not in (None, d)]
+        if wrong:
+            print '** digest differs from registered digest, leaving it alone:', wrong[0]
+            continue
+        by_digest.setdefault(d, []).append(key)
+
+    reclaimed = 0
+    relinked = 0
+    for (d, keys) in sorted(by_digest.items()):
+        if len(keys) < 2 and not store_all:
+            continue
+        if dry_run:
+            reclaimed += sizes[keys[0]] * (len(keys) - 1)
+            continue
+        for key in keys:
+            (freed, count) = store(repo, d, inodes[key])
+            reclaimed += freed
+            relinked += count
+    return (reclaimed, relinked)
+
+# Make paths, which all share one inode, hard links to the blob for
+# sha256, putting the file in the blob area if the blob isn't there
+# yet.  Returns (bytes freed, number of paths relinked).
+
+def store(repo, sha256, paths):
+    bpath = blob_path(repo, sha256)
+    st = os.stat(paths[0])
+    try:
+        bst = os.stat(bpath)
+    except OSError:
+        bst = None
+    if bst == None:
+        bdir = os.path.dirname(bpath)
+        if not os.path.isdir(bdir):
+            os.makedirs(bdir)
+        os.link(paths[0], bpath)
+        return (0, 0)
+    if (bst.st_dev, bst.st_ino) == (st.st_dev, st.st_ino):
+        return (0, 0)           # already stored
+    if bst.st_size != st.st_size:
+        print '** blob has wrong size, not using it:', bpath
+        return (0, 0)
+    for path in paths:
+        replace_with_link(bpath, path)
+    # Space comes back only if nothing else links to the old inode
+    if st.st_nlink == len(paths):
+        return (st.st_size, len(paths))
+    return (0, len(paths))
+
+def replace_with_link(src, path):
+    tmp = '%s.dedup-%s' % (path, os.getpid())
+    os.link(src, tmp)
+    try:
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    fileutil.fsync_dir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('repo', help="root of local files.opentreeoflife.org repo checkout")
+    p.add_argument('resources')
+    p.add_argument('captures')
+    p.add_argument('--jobs', type=int, help='hashing processes, default one per core')
+    p.add_argument('--dry-run', action='store_true',
+                   help='just report how much space would be reclaimed')
+    p.add_argument('--all', action='store_true',
+                   help='put every capture file in the blob area, not just duplicates')
+    args = p.parse_args()
+    the_registry = registry.Registry(args.resources, args.captures)
+    (reclaimed, relinked) = dedup(the_registry, args.repo, args.jobs, args.dry_run, args.all)
+    if args.dry_run:
+        print 'would reclaim', transfer.human_bytes(reclaimed)
+    else:
+        print 'relinked', relinked, 'files, reclaimed', transfer.human_bytes(reclaimed)
@@ -0,0 +1,62 @@
+# SHA-256 digests of capture files.
+
+# Files are read unbuffered in large chunks, so big captures
+# (multi-gigabyte taxdump and OTT tarballs) hash at about disk speed.
+# (Not memory-mapped: a read error on a mapped file is a SIGBUS, which
+# would kill the process instead of being reported.)  hash_files
+# spreads a list of files over a pool of processes, one file per task.
+
+# python digest.py file...
+
+import os, sys, hashlib
+from multiprocessing import Pool
+
+chunk_size = 16 << 20
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb', 0) as infile:
+        while True:
+            chunk = infile.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+# Returns (path, hex digest or None, error message or None)
+
+def try_sha256_file(path):
+    try:
+        return (path, sha256_file(path), None)
+    except (IOError, OSError), e:
+        return (path, None, str(e))
+
+# Returns dict path -> hex digest; unreadable files are reported and
+# left out
+
+def hash_files(paths, jobs=None):
+    if len(paths) == 0:
+        return {}
+    if jobs == 1 or len(paths) == 1:
+        results = map(try_sha256_file, paths)
+    else:
+        pool = Pool(jobs)
+        try:
+            results = pool.map(try_sha256_file, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    digests = {}
+    for (path, digest, error) in results:
+        if digest == None:
+            print '** could not compute digest', path, error
+        else:
+            digests[path] = digest
+    return digests
+
+
+if __name__ == '__main__':
+    digests = hash_files(sys.argv[1:])
+    for path in sys.argv[1:]:
+        if path in digests:
+            print '%s  %s' % (digests[path], path)
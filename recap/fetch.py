@@ -0,0 +1,205 @@
+# Resumable download of one capture file.
+
+# Downloads go to <dst>.tmp, which is kept if the transfer is cut off;
+# the next attempt asks for the rest of the file with an HTTP Range
+# request instead of starting over.  When the download is complete
+# its size and (if given) SHA-256 are checked, and only then is it
+# renamed to <dst>.  With --parallel N, a large file is fetched as N
+# byte ranges at once, each into its own (likewise resumable) part
+# file, and the parts are joined at the end.  The parts are kept until
+# the joined file has passed its checks, so that a failure anywhere
+# along the way doesn't lose what has been fetched.
+
+# python fetch.py --bytes 24852339 "http://..." repo/ncbi/ncbi-20130227/ncbi-20130227.tgz
+
+import os, sys, socket, shutil, argparse, threading, httplib, urllib2
+import digest
+
+block_size = 1 << 20
+min_part_size = 64 << 20        # don't split files smaller than this
+unreachable_status = 3          # exit status when the host can't be reached
+
+# unreachable says the host couldn't be reached at all (connection
+# refused, timeout, unknown name), as opposed to e.g. a 404
+
+class FetchError(Exception):
+    def __init__(self, message, unreachable=False):
+        Exception.__init__(self, message)
+        self.unreachable = unreachable
+
+def fetch(url, dst, size=None, sha256=None, parallel=1):
+    tmp = dst + '.tmp'
+    if size == None or parallel > 1:
+        (length, ranges) = head(url)
+        if size == None:
+            size = length
+        elif length != None and length != size:
+            raise FetchError('%s has %s bytes, expected %s' % (url, length, size))
+    else:
+        ranges = False
+    if parallel > 1 and ranges and size != None and size >= 2 * min_part_size:
+        parts = fetch_parts(url, tmp, size, min(parallel, size // min_part_size))
+        try:
+            check(tmp, size, sha256)
+        except FetchError:
+            if not os.path.exists(tmp):
+                # Thrown away as corrupt, so the parts are too
+                remove_parts(parts)
+            raise
+        os.rename(tmp, dst)
+        remove_parts(parts)
+    else:
+        fetch_range(url, tmp, 0, size)
+        check(tmp, size, sha256)
+        os.rename(tmp, dst)
+
+# Fetch bytes [start, end) of url into path, continuing from whatever
+# is already in path.  end None means to the end of the file.
+
+def fetch_range(url, path, start, end):
+    have = 0
+    if os.path.exists(path):
+        have = os.path.getsize(path)
+    if end != None and have >= end - start:
+        if have > end - start:
+            raise FetchError('%s is longer than expected' % path)
+        return
+    request = urllib2.Request(url)
+    if start + have > 0 or end != None:
+        if end != None:
+            request.add_header('Range', 'bytes=%d-%d' % (start + have, end - 1))
+        else:
+            request.add_header('Range', 'bytes=%d-' % (start + have,))
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if e.code == 416 and end == None and have > 0:
+            return              # range not satisfiable: already have it all
+        raise FetchError('%s: %s' % (url, e))
+    except urllib2.URLError, e:
+        raise FetchError('%s: %s' % (url, e.reason), url_unreachable(e))
+    if response.getcode() == 206:
+        mode = 'ab'
+        if have > 0:
+            print 'resuming', url, 'at', start + have
+    elif start == 0:
+        # Server ignored the range; start over
+        mode = 'wb'
+    else:
+        raise FetchError('%s: server does not do byte ranges' % url)
+    with open(path, mode) as outfile:
+        try:
+            while True:
+                block = response.read(block_size)
+                if not block:
+                    break
+                outfile.write(block)
+        except (socket.error, httplib.HTTPException), e:
+            # Cut off; what has arrived is kept, to resume from
+            raise FetchError('%s: %s' % (url, str(e) or e.__class__.__name__))
+        finally:
+            outfile.flush()
+            os.fsync(outfile.fileno())
+            response.close()
+    # httplib can also just stop short when the connection closes
+    if end != None and os.path.getsize(path) < end - start:
+        raise FetchError('%s: got %s of %s bytes' % (url, os.path.getsize(path), end - start))
+
+def fetch_parts(url, tmp, size, count):
+    part_size = (size + count - 1) // count
+    parts = []
+    for i in range(count):
+        start = i * part_size
+        parts.append(('%s.part%d' % (tmp, i), start, min(start + part_size, size)))
+    errors = []
+    def run(part):
+        try:
+            fetch_range(url, *part)
+        except FetchError, e:
+            errors.append(e)
+        except Exception, e:
+            errors.append(FetchError('%s: %s' % (part[0], str(e) or e.__class__.__name__)))
+    threads = [threading.Thread(target=run, args=(part,)) for part in parts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    for (path, start, end) in parts:
+        have = file_size(path)
+        if have != end - start:
+            if have > end - start:
+                os.remove(path)     # start this one over next time
+            raise FetchError('%s has %s bytes, expected %s' % (path, have, end - start))
+    with open(tmp, 'wb') as outfile:
+        for (path, start, end) in parts:
+            with open(path, 'rb') as infile:
+                shutil.copyfileobj(infile, outfile, block_size)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    return [path for (path, start, end) in parts]
+
+def remove_parts(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def file_size(path):
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return None
+
+# Returns (Content-Length or None, whether byte ranges are supported)
+
+def head(url):
+    request = urllib2.Request(url)
+    request.get_method = lambda: 'HEAD'
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        raise FetchError('%s: %s' % (url, e))
+    except urllib2.URLError, e:
+        raise FetchError('%s: %s' % (url, e.reason), url_unreachable(e))
+    length = response.info().getheader('content-length')
+    ranges = response.info().getheader('accept-ranges') == 'bytes'
+    response.close()
+    if length != None and length.isdigit():
+        return (int(length), ranges)
+    return (None, ranges)
+
+def url_unreachable(e):
+    return isinstance(e.reason, (socket.error, socket.timeout))
+
+# A bad download is thrown away, so the next attempt starts over
+# rather than resuming something corrupt
+
+def check(tmp, size, sha256):
+    have = os.path.getsize(tmp)
+    if size != None and have != size:
+        if have > size:
+            os.remove(tmp)
+        raise FetchError('%s has %s bytes, expected %s' % (tmp, have, size))
+    if sha256 != None:
+        have = digest.sha256_file(tmp)
+        if have != sha256:
+            os.remove(tmp)
+            raise FetchError('%s has digest %s, expected %s' % (tmp, have, sha256))
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('url')
+    p.add_argument('dst')
+    p.add_argument('--bytes', type=int, help='expected size')
+    p.add_argument('--sha256', help='expected digest')
+    p.add_argument('--parallel', type=int, default=1,
+                   help='fetch a large file as this many byte ranges at once')
+    args = p.parse_args()
+    try:
+        fetch(args.url, args.dst, args.bytes, args.sha256, args.parallel)
+    except FetchError, e:
+        print '** fetch failed:', e
+        if e.unreachable:
+            sys.exit(unreachable_status)
+        sys.exit(1)
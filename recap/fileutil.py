@@ -0,0 +1,57 @@
+# Crash-safe file replacement and advisory locking for registry files.
+
+# Writers replace a file by writing a temporary file in the same
+# directory, fsyncing it, and renaming it over the target, so a crash
+# leaves either the old or the new contents, never a mixture.  Readers
+# therefore never need a lock: whatever they open is complete.
+# Read-modify-write cycles take an exclusive fcntl lock on a separate
+# <path>.lock file so that two writers can't clobber each other.
+
+import os, fcntl, tempfile, contextlib
+
+@contextlib.contextmanager
+def atomic_write(path):
+    dir = os.path.dirname(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(dir=dir, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as outfile:
+            yield outfile
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.chmod(tmp, 0644)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    fsync_dir(dir)
+
+def fsync_dir(dir):
+    fd = os.open(dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextlib.contextmanager
+def locked(path):
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+# Identifies a particular version of a file: changes whenever the file
+# is replaced or rewritten.  None if there is no file.
+
+def signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return stat_signature(st)
+
+def stat_signature(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
@@ -0,0 +1,157 @@
+# Allocation of special ids from a fixed pool.
+
+# The pool is a sorted JSON list of ids (the same format the unused
+# ids file always had) and is never rewritten once created.  What gets
+# updated is a small cursor file next to it holding the position of
+# the next unallocated id in the pool.  Each process reserves a block
+# of ids by advancing the cursor under an fcntl lock, so several
+# registration processes can allocate at once without handing out the
+# same id twice, and then hands ids out of its block without touching
+# the disk.  release() gives back the unused tail of the block by
+# moving the cursor back, if no one else has reserved since.
+
+# Ids that can't be given back that way (someone else has reserved
+# since, or they were handed out and then not used - see give_back)
+# go on a free list in a third file, <pool>.free, which is rewritten
+# under the cursor's lock.  reserve() takes from the free list first.
+
+import os, json, fcntl, fileutil
+
+default_block_size = 16
+
+class Exhausted(Exception):
+    pass
+
+class IdAllocator:
+    def __init__(self, path, block_size=default_block_size):
+        self.path = path
+        self.cursor_path = path + '.cursor'
+        self.free_path = path + '.free'
+        self.block_size = block_size
+        self.pool = None
+        self.block = []         # reserved ids not yet handed out
+        self.block_end = None   # cursor value just after our block
+
+    # Create the pool if there isn't one already.  Reserved ids are
+    # never handed out.
+    def create(self, ids, reserved=()):
+        if os.path.exists(self.path):
+            return False
+        pool = sorted(set(ids) - set(reserved))
+        with fileutil.atomic_write(self.path) as outfile:
+            json.dump(pool, outfile, indent=1)
+        for path in [self.cursor_path, self.free_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        return True
+
+    def load_pool(self):
+        if self.pool == None:
+            with open(self.path) as infile:
+                self.pool = json.load(infile)
+        return self.pool
+
+    def allocate(self):
+        if len(self.block) == 0:
+            self.reserve()
+        return self.block.pop(0)
+
+    def reserve(self):
+        pool = self.load_pool()
+        with CursorFile(self.cursor_path) as cursor:
+            free = self.read_free()
+            if len(free) > 0:
+                self.block = free[:self.block_size]
+                self.block_end = None       # not from the cursor
+                self.write_free(free[self.block_size:])
+                return
+            start = cursor.read()
+            if start >= len(pool):
+                raise Exhausted('no more unused ids in %s' % self.path)
+            end = min(start + self.block_size, len(pool))
+            cursor.write(end)
+        self.block = pool[start:end]
+        self.block_end = end
+
+    def release(self):
+        if len(self.block) == 0:
+            return
+        pool = self.load_pool()
+        with CursorFile(self.cursor_path) as cursor:
+            # The part of the block that is still the tail of what we
+            # reserved goes back by moving the cursor; the rest goes on
+            # the free list
+            n = 0
+            if self.block_end != None and cursor.read() == self.block_end:
+                while n < min(len(self.block), self.block_end) and \
+                      self.block[-1 - n] == pool[self.block_end - 1 - n]:
+                    n += 1
+                cursor.write(self.block_end - n)
+            rest = self.block[:len(self.block) - n]
+            if len(rest) > 0:
+                self.write_free(sorted(self.read_free() + rest))
+        self.block = []
+        self.block_end = None
+
+    # Take back ids that allocate() handed out but that ended up not
+    # being used, e.g. in a batch that was aborted.  They're handed out
+    # again before the rest of the block, and release() returns them
+    # with it.
+    def give_back(self, ids):
+        self.block = sorted(set(ids) | set(self.block))
+
+    # Ids not yet reserved by anyone
+    def remaining(self):
+        pool = self.load_pool()
+        with CursorFile(self.cursor_path) as cursor:
+            return sorted(pool[cursor.read():] + self.read_free())
+
+    # The free list; only while holding the cursor's lock
+    def read_free(self):
+        if not os.path.exists(self.free_path):
+            return []
+        with open(self.free_path) as infile:
+            return json.load(infile)
+
+    def write_free(self, ids):
+        if len(ids) == 0:
+            if os.path.exists(self.free_path):
+                os.remove(self.free_path)
+            return
+        with fileutil.atomic_write(self.free_path) as outfile:
+            json.dump(ids, outfile, indent=1)
+
+    def wipe(self):
+        for path in [self.path, self.cursor_path, self.free_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.pool = None
+        self.block = []
+        self.block_end = None
+
+# The cursor is one fixed-width decimal number, locked and rewritten in
+# place.
+
+class CursorFile:
+    width = 12
+    def __init__(self, path):
+        self.path = path
+    def __enter__(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        self.file = os.fdopen(fd, 'r+')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+    def __exit__(self, type, value, traceback):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+    def read(self):
+        self.file.seek(0)
+        text = self.file.read().strip()
+        if text == '':
+            return 0
+        return int(text)
+    def write(self, value):
+        self.file.seek(0)
+        self.file.write('%*d\n' % (self.width, value))
+        self.file.flush()
+        os.fsync(self.file.fileno())
@@ -0,0 +1,165 @@
+# Append-only journal storage for registry tables.
+
+# A journal table is kept in two files: a snapshot, which has the same
+# format as an ordinary JSON table (so existing registry files can be
+# used as snapshots as they are), and a journal next to it holding one
+# JSON put record per line.  flush() appends the records put since the
+# last flush and fsyncs, so registering one capture costs one small
+# append instead of rewriting the whole table.  Opening the table
+# reads the snapshot and replays the journal.  compact() folds the
+# journal into a new snapshot.
+
+# Readers take no lock.  Compaction replaces the snapshot first and
+# only then removes the journal, so a reader that has read the old
+# snapshot may find the journal gone (or already started afresh) and
+# miss records that are now in the new snapshot.  A reader therefore
+# checks, after replaying, that the snapshot it read is still the
+# current one, and reads both again if not.
+
+# python journal.py compact var/recap/initial_captures.json
+# python journal.py export var/recap/initial_captures.json captures.json
+
+import os, sys, json, registry, fileutil
+
+# Compact automatically once the journal has this many records
+default_compact_threshold = 10000
+
+class JournalTable(registry.Table):
+    def __init__(self, path, journal_path=None,
+                 compact_threshold=default_compact_threshold):
+        registry.Table.__init__(self, path)
+        if journal_path == None:
+            journal_path = path + '.journal'
+        self.journal_path = journal_path
+        self.compact_threshold = compact_threshold
+        self.journal_count = 0    # records in the journal file
+        self.journal_size = 0     # bytes of the journal file replayed
+
+    cached_fields = registry.Table.cached_fields + ['journal_count', 'journal_size']
+
+    def rebuild(self):
+        while True:
+            registry.Table.rebuild(self)
+            self.journal_count = 0
+            for blob in self.replay():
+                self.put(blob['name'], blob)
+                self.journal_count += 1
+            if fileutil.signature(self.path) == self.signature:
+                break
+            print 'snapshot replaced while reading, reading again', self.path
+
+    def cache_key(self):
+        return (fileutil.signature(self.path), fileutil.signature(self.journal_path))
+
+    # Don't cache a replay that stopped short of the end of the journal
+    def loaded_key(self):
+        journal = fileutil.signature(self.journal_path)
+        if journal != None and os.path.getsize(self.journal_path) != self.journal_size:
+            return None
+        if self.signature == None and journal == None:
+            return None
+        return (self.signature, journal)
+
+    # Records from the journal file, in order.  A torn final record
+    # (crash during append, or an append in progress in another
+    # process) is ignored; the next writer cuts it off.
+    def replay(self):
+        self.journal_size = 0   # offset just past last good record
+        if not os.path.exists(self.journal_path):
+            return []
+        blobs = []
+        with open(self.journal_path) as infile:
+            print 'replaying', self.journal_path
+            for line in iter(infile.readline, ''):
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('no newline')
+                    blobs.append(json.loads(line))
+                except ValueError:
+                    print '** ignoring incomplete journal record', self.journal_path, len(blobs)
+                    break
+                self.journal_size += len(line)
+        return blobs
+
+    def journal_changed(self):
+        if os.path.exists(self.journal_path):
+            size = os.path.getsize(self.journal_path)
+        else:
+            size = 0
+        return (fileutil.signature(self.path) != self.signature or
+                size != self.journal_size)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with fileutil.locked(self.path):
+            if self.journal_changed():
+                self.merge()
+            if os.path.exists(self.journal_path) and \
+               os.path.getsize(self.journal_path) > self.journal_size:
+                # We hold the lock, so this is a torn record, not an append
+                print '** cutting off incomplete journal record', self.journal_path
+                with open(self.journal_path, 'r+') as outfile:
+                    outfile.truncate(self.journal_size)
+            with open(self.journal_path, 'a') as outfile:
+                for blob in self.pending:
+                    outfile.write(json.dumps(blob, sort_keys=True))
+                    outfile.write('\n')
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                self.journal_size = os.fstat(outfile.fileno()).st_size
+            self.journal_count += len(self.pending)
+            self.pending = []
+            if self.compact_threshold != None and self.journal_count >= self.compact_threshold:
+                self.compact_locked()
+
+    # Write everything to the snapshot and start a new, empty journal.
+    # If we crash between the two steps, replaying the old journal over
+    # the new snapshot is harmless, since re-putting a blob is a no-op.
+    def compact(self):
+        self.swapin()
+        with fileutil.locked(self.path):
+            if self.journal_changed():
+                self.merge()
+            self.compact_locked()
+
+    def compact_locked(self):
+        self.dump(self.path)
+        self.signature = fileutil.signature(self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_count = 0
+        self.journal_size = 0
+        self.pending = []
+
+    # Plain JSON copy of the table, readable by registry.Table
+    def export(self, path):
+        self.swapin()
+        self.dump(path)
+
+    # Load the blobs from a plain JSON table file
+    def import_json(self, path):
+        with open(path) as infile:
+            for blob in json.load(infile):
+                self.put(blob['name'], blob)
+        self.flush()
+
+    def wipe(self):
+        registry.Table.wipe(self)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_count = 0
+        self.journal_size = 0
+
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    table = JournalTable(sys.argv[2])
+    if command == 'compact':
+        table.compact()
+    elif command == 'export':
+        table.export(sys.argv[3])
+    elif command == 'import':
+        table.import_json(sys.argv[3])
+    else:
+        print '** unrecognized command', command
@@ -0,0 +1,220 @@
+# Lazily decoded JSON tables.
+
+# A LazyTable reads the same JSON file as registry.Table, but doesn't
+# hold on to the blobs.  Opening it scans the file once, through a
+# memory map, to find where each record starts and ends, and keeps only
+# those offsets plus the few fields that lookups need (id, capture_of,
+# date).  A blob is decoded from the map the first time it's asked
+# for, so memory tracks what is accessed rather than the size of the
+# table.  The offsets go in the snapshot cache just as the ordinary
+# indexes do, so a warm start doesn't scan at all.
+
+import os, re, mmap, json, bisect, registry, fileutil
+
+# Fields kept for every record without decoding it; select() on any
+# other field has to decode every record once
+indexed_fields = ['id', 'capture_of', 'date']
+
+# Strings (skipped whole, so braces inside them don't count) and braces
+token_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|([{}])')
+
+class LazyTable(registry.Table):
+    cached_fields = ['spans', 'ids', 'signature']
+    cache_suffix = '.lazycache'
+
+    def __init__(self, path, cache=True):
+        registry.Table.__init__(self, path, cache)
+        self.spans = None       # name -> (start, end, id, capture_of, date)
+        self.ids = None         # id -> name
+        self.decoded = {}       # name -> blob, decoded so far or put since
+        self.map = None
+
+    def swapin(self):
+        if self.spans == None:
+            self.refresh()
+
+    def refresh(self):
+        self.close()
+        self.decoded = {}
+        registry.Table.refresh(self)
+        self.index_by_name = NameIndex(self)
+        self.index_by_id = IdIndex(self)
+
+    def rebuild(self):
+        self.spans = {}
+        self.ids = {}
+        if not os.path.exists(self.path):
+            self.signature = None
+            return
+        self.signature = self.open()
+        print 'scanning', self.path
+        depth = 0
+        for m in token_pattern.finditer(self.map):
+            brace = m.group(1)
+            if brace == '{':
+                depth += 1
+                if depth == 1:
+                    start = m.start()
+            elif brace == '}':
+                depth -= 1
+                if depth == 0:
+                    # Decode once to get the name and indexed fields,
+                    # then let the blob go
+                    blob = json.loads(self.map[start:m.end()])
+                    self.spans[blob['name']] = (start, m.end()) + key_fields(blob)
+                    if 'id' in blob:
+                        self.ids[blob['id']] = blob['name']
+
+    # Map the file; returns the signature of what got mapped
+    def open(self):
+        with open(self.path, 'rb') as infile:
+            st = os.fstat(infile.fileno())
+            self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return fileutil.stat_signature(st)
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+
+    def record(self, name):
+        blob = self.decoded.get(name)
+        if blob == None:
+            blob = self.decode(name)
+            if blob != None:
+                self.decoded[name] = blob
+        return blob
+
+    # Decode a record from the map, without keeping it
+    def decode(self, name):
+        span = self.spans.get(name)
+        if span == None:
+            return None
+        if self.map == None and self.open() != self.signature:
+            # File was replaced since the offsets were taken.  Rescan,
+            # keeping puts not yet flushed, as Table.merge does.
+            self.merge()
+            return self.decode(name)
+        return json.loads(self.map[span[0]:span[1]])
+
+    def names(self):
+        names = set(self.spans)
+        names.update(self.decoded)
+        return names
+
+    # (id, capture_of, date) without decoding if possible
+    def fields(self, name):
+        span = self.spans.get(name)
+        if span != None:
+            return span[2:]
+        return key_fields(self.decoded[name])
+
+    def view(self, field):
+        self.swapin()
+        views = self.views.get(field)
+        if views == None:
+            groups = {}
+            for name in self.names():
+                fields = self.fields(name)
+                if field == None:
+                    key = None
+                elif field in indexed_fields:
+                    key = fields[indexed_fields.index(field)]
+                else:
+                    # Linear scan: decode the record just long enough
+                    # to get the field
+                    blob = self.decoded.get(name)
+                    if blob == None:
+                        blob = self.decode(name)
+                    key = blob.get(field)
+                groups.setdefault(key, []).append((fields[2], name))
+            views = {}
+            for key in groups:
+                views[key] = NameView(groups[key])
+            self.views[field] = views
+        return views
+
+    def select(self, field=None, value=None):
+        view = self.view(field).get(value)
+        if view == None:
+            return []
+        return [self.record(name) for name in view.names]
+
+    def add_to_views(self, blob):
+        for field in self.views:
+            if field != None:
+                key = blob.get(field)
+            else:
+                key = None
+            views = self.views[field]
+            if not key in views:
+                views[key] = NameView([])
+            views[key].add(blob)
+
+    # Writing decodes everything; start afresh from the new file after
+    def flush(self):
+        if self.spans == None:
+            return
+        registry.Table.flush(self)
+        self.forget()
+
+    def abort(self):
+        registry.Table.abort(self)
+        self.forget()
+
+    def wipe(self):
+        registry.Table.wipe(self)
+        self.forget()
+
+    def forget(self):
+        self.close()
+        self.spans = None
+        self.ids = None
+        self.decoded = {}
+
+def key_fields(blob):
+    return (blob.get('id'), blob.get('capture_of'), blob.get('date'))
+
+# Stand-ins for Table's index dicts, so Table.get / get_by_id / put /
+# values / dump work unchanged
+
+class NameIndex:
+    def __init__(self, table):
+        self.table = table
+    def get(self, name):
+        return self.table.record(name)
+    def __getitem__(self, name):
+        return self.table.record(name)
+    def __contains__(self, name):
+        return name in self.table.spans or name in self.table.decoded
+    def __setitem__(self, name, blob):
+        self.table.decoded[name] = blob
+    def values(self):
+        return [self.table.record(name) for name in self.table.names()]
+
+class IdIndex:
+    def __init__(self, table):
+        self.table = table
+    def get(self, id):
+        name = self.table.ids.get(id)
+        if name == None:
+            return None
+        return self.table.record(name)
+    def __getitem__(self, id):
+        return self.table.record(self.table.ids[id])
+    def __contains__(self, id):
+        return id in self.table.ids
+    def __setitem__(self, id, blob):
+        self.table.ids[id] = blob['name']
+
+# Like registry.DateView, but of names, so nothing has to be decoded
+
+class NameView:
+    def __init__(self, dated_names):
+        dated_names = sorted(dated_names, key=lambda (date, name):date)
+        self.dates = [date for (date, name) in dated_names]
+        self.names = [name for (date, name) in dated_names]
+    def add(self, blob):
+        i = bisect.bisect_right(self.dates, blob['date'])
+        self.dates.insert(i, blob['date'])
+        self.names.insert(i, blob['name'])
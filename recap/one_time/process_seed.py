@@ -27,7 +27,7 @@ def load_setup_data(setup_data_path=default_setup_data_path):
 allowed_keys = ["name", "retrieved_from", "original_suffix", "derived_suffix", "legal", "===", "ott_idspace"]
 resource_allowed_keys = allowed_keys + ["issues", "description", "capture_description", "issue_prefix", "doi"]
 issue_allowed_keys = allowed_keys + ["original", "derived", "derived_from"]
-capture_allowed_keys = allowed_keys + ["locations", "bytes", "doi",
+capture_allowed_keys = allowed_keys + ["locations", "bytes", "sha256", "doi",
                                         "sources", "from", "commit",
                                         "retrieved_from", "retrievable_from",
                                         "generated_on", "last_modified", "publication_date"]
@@ -14,20 +14,25 @@ def register_from_setup_data(setup_file, re, cap):
     commands = process_seed.get_setup_commands(setup_file)
 
     if do_ids:
-        registry = recap.registry.Registry(re, cap, 'unused_ids.csv')
+        # Hand out the gaps in the OTT 1.0 sequence, but not the magic ids
+        registry = recap.registry.Registry(re, cap, 'unused_ids.csv',
+            id_seed=recap.registry.initial_unused_ids + process_seed.available_ids,
+            reserved_ids=process_seed.magic_ids)
     else:
         registry = recap.registry.Registry(re, cap)
     registry.wipe()
 
-    for command in commands:
-        type = command['_type']
-        if type == 'resource':
-            registry.register_resource(command)
-        elif type == 'capture':
-            registry.register_capture(command)
-        # maybe taxa too?
-        else:
-            print '** unrecognized command type', type
+    # One write per table, at the end, instead of one per command
+    with registry.batch():
+        for command in commands:
+            type = command['_type']
+            if type == 'resource':
+                registry.register_resource(command)
+            elif type == 'capture':
+                registry.register_capture(command)
+            # maybe taxa too?
+            else:
+                print '** unrecognized command type', type
 
 # when done, eyeball the registry files, for fun.
 
@@ -0,0 +1,150 @@
+# Checking http(s) capture locations before trying to fetch from them.
+
+# probe_urls sends a HEAD request to every URL and records the status,
+# Content-Length and Last-Modified.  URLs are grouped by host; each
+# host gets a few threads, and each thread keeps one HTTP connection
+# open and sends its requests over it, so probing hundreds of files
+# on one mirror costs a handful of connections, and slow hosts don't
+# hold up others.  (This is Python 2, so threads rather than asyncio;
+# the work is all waiting on the network either way.)
+
+# python probe.py url...
+
+import sys, time, socket, httplib, urlparse, threading, Queue
+
+default_per_host = 4
+default_timeout = 30
+max_redirects = 5
+
+class Probe:
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.length = None          # Content-Length, as an int
+        self.last_modified = None
+        self.location = None        # final URL after redirects
+        self.error = None
+        self.unreachable = False    # error was failing to reach the host
+        self.seconds = None         # round trip time of the request
+    def ok(self):
+        return self.status == 200
+    def describe(self):
+        if self.error != None:
+            return 'error: %s' % self.error
+        return '%s %s bytes, last modified %s' % (self.status, self.length, self.last_modified)
+
+# Returns dict url -> Probe
+
+def probe_urls(urls, per_host=default_per_host, timeout=default_timeout):
+    by_host = {}
+    for url in urls:
+        parsed = urlparse.urlparse(url)
+        by_host.setdefault((parsed.scheme, parsed.netloc), []).append(url)
+    probes = {}
+    threads = []
+    for ((scheme, netloc), host_urls) in by_host.items():
+        queue = Queue.Queue()
+        for url in host_urls:
+            queue.put(url)
+        for i in range(min(per_host, len(host_urls))):
+            thread = threading.Thread(target=probe_worker,
+                                      args=(scheme, netloc, queue, probes, timeout))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return probes
+
+def probe_worker(scheme, netloc, queue, probes, timeout):
+    connection = None
+    while True:
+        try:
+            url = queue.get_nowait()
+        except Queue.Empty:
+            break
+        if connection == None:
+            connection = make_connection(scheme, netloc, timeout)
+        probe = Probe(url)
+        try:
+            head(connection, url, probe)
+        except (socket.error, httplib.HTTPException), e:
+            # The connection may just have gone stale; try once more on
+            # a new one
+            connection.close()
+            connection = make_connection(scheme, netloc, timeout)
+            try:
+                head(connection, url, probe)
+            except (socket.error, httplib.HTTPException), e:
+                probe.error = str(e) or e.__class__.__name__
+                probe.unreachable = isinstance(e, socket.error)
+                connection.close()
+                connection = None
+        if probe.error == None and probe.status in redirect_statuses:
+            follow_redirects(probe, timeout)
+        probes[url] = probe
+    if connection != None:
+        connection.close()
+
+def make_connection(scheme, netloc, timeout):
+    if scheme == 'https':
+        return httplib.HTTPSConnection(netloc, timeout=timeout)
+    else:
+        return httplib.HTTPConnection(netloc, timeout=timeout)
+
+# Fills in probe from a HEAD of url.  Each hop of a redirect is a new
+# response, so nothing is kept from the last one.
+
+def head(connection, url, probe):
+    probe.status = None
+    probe.length = None
+    probe.last_modified = None
+    parsed = urlparse.urlparse(url)
+    path = parsed.path or '/'
+    if parsed.query:
+        path = path + '?' + parsed.query
+    start = time.time()
+    connection.request('HEAD', path)
+    response = connection.getresponse()
+    response.read()             # nothing, but needed to reuse the connection
+    probe.seconds = time.time() - start
+    probe.status = response.status
+    length = response.getheader('content-length')
+    if length != None and length.isdigit():
+        probe.length = int(length)
+    probe.last_modified = response.getheader('last-modified')
+    location = response.getheader('location')
+    if location != None:
+        probe.location = urlparse.urljoin(url, location)
+
+# Redirects (e.g. http -> https) go to other hosts, so use a new
+# connection for each
+
+redirect_statuses = (301, 302, 303, 307, 308)
+
+def follow_redirects(probe, timeout):
+    for i in range(max_redirects):
+        url = probe.location
+        if url == None:
+            probe.error = 'redirect with no location'
+            return
+        parsed = urlparse.urlparse(url)
+        connection = make_connection(parsed.scheme, parsed.netloc, timeout)
+        probe.location = None
+        try:
+            head(connection, url, probe)
+        except (socket.error, httplib.HTTPException), e:
+            probe.error = str(e) or e.__class__.__name__
+            return
+        finally:
+            connection.close()
+        if not probe.status in redirect_statuses:
+            probe.location = url
+            return
+    probe.error = 'too many redirects'
+
+
+if __name__ == '__main__':
+    probes = probe_urls(sys.argv[1:])
+    for url in sys.argv[1:]:
+        print url, probes[url].describe()
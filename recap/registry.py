@@ -1,54 +1,121 @@
 # Register one resource or version
 
-import os, json, registry
+import os, json, bisect, contextlib, cPickle, registry, idalloc, fileutil
 
 default_registry_dir = '../var/the_registry'
 
 #  The registry
 
 class Registry:
-    def __init__(self, resources_path, captures_path, unused_ids_path=None):
-        self.resources = Table(resources_path)
-        self.captures = Table(captures_path)
+    def __init__(self, resources_path, captures_path, unused_ids_path=None,
+                 storage=None, id_seed=None, reserved_ids=()):
+        self.resources = make_table(resources_path, storage)
+        self.captures = make_table(captures_path, storage)
         self.unused_ids_path = unused_ids_path
+        if unused_ids_path != None:
+            self.allocator = idalloc.IdAllocator(unused_ids_path)
+        else:
+            self.allocator = None
+        if id_seed == None:
+            id_seed = initial_unused_ids
+        self.id_seed = id_seed
+        self.reserved_ids = reserved_ids
+        self.batching = False
+        self.batch_ids = []     # special ids handed out in this batch
 
     def get_resource(self, name):
         return self.resources.get(name)
 
+    def get_resource_by_id(self, id):
+        return self.resources.get_by_id(id)
+
+    def get_capture(self, name):
+        return self.captures.get(name)
+
+    def get_capture_by_id(self, id):
+        return self.captures.get_by_id(id)
+
     def register_resource(self, rmeta):
         rmeta = validate_resource(rmeta)
         self.resources.put(rmeta['name'], rmeta)
-        self.resources.flush()
+        if not self.batching:
+            self.resources.flush()
 
     def register_capture(self, cmeta):
         cmeta = validate_capture(cmeta, self)
-        self.captures.put(cmeta['name'], cmeta)
-        if not 'id' in cmeta and self.unused_ids_path != None:
+        if cmeta == None:
+            return
+        # Assign the id first so that put indexes it
+        if not 'id' in cmeta and self.unused_ids_path != None and \
+           self.captures.get(cmeta['name']) == None:
             cmeta['id'] = self.next_special_id()
+            if self.batching:
+                self.batch_ids.append(cmeta['id'])
+        self.captures.put(cmeta['name'], cmeta)
+        if not self.batching:
+            self.captures.flush()
+            self.release_ids()
+
+    # Batched registration.  Between begin() and commit(), puts are
+    # validated and held in memory; each table is written once, at
+    # commit.  abort() throws away everything put since begin(), and
+    # gives back the special ids it assigned.
+
+    def begin(self):
+        if self.batching:
+            print '** already in a batch'
+        else:
+            self.batch_ids = []
+        self.batching = True
+
+    def commit(self):
+        self.batching = False
+        self.batch_ids = []
+        self.resources.flush()
         self.captures.flush()
+        self.release_ids()
+
+    def abort(self):
+        self.batching = False
+        self.resources.abort()
+        self.captures.abort()
+        if self.allocator != None:
+            self.allocator.give_back(self.batch_ids)
+        self.batch_ids = []
+        self.release_ids()
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.begin()
+        try:
+            yield self
+        except:
+            self.abort()
+            raise
+        self.commit()
 
     def next_special_id(self):
-        self.wipe_unused()
-        with open(self.unused_ids_path) as infile:
-            ids = json.load(infile)
-        id = ids[0]
-        ids = ids[1:]
-        with open(self.unused_ids_path, 'w') as outfile:
-            json.dump(ids, outfile, indent=1)
-        return id
+        if not os.path.exists(self.unused_ids_path):
+            self.wipe_unused()
+        while True:
+            id = self.allocator.allocate()
+            # Skip ids that were registered explicitly
+            if self.captures.get_by_id(id) == None:
+                return id
+
+    # Give back ids reserved but not handed out
+    def release_ids(self):
+        if self.allocator != None:
+            self.allocator.release()
 
     def all_resources(self):
-        return sorted(self.resources.values(), key=lambda rmeta:rmeta['date'])
+        return self.resources.select()
 
     def all_captures(self, capture_of=None):
-        captures = self.captures.values()
         if capture_of != None:
-            all = []
-            for cmeta in captures:
-                if cmeta['capture_of'] == capture_of:
-                    all.append(cmeta)
-            captures = all
-        return sorted(captures, key=lambda cmeta:cmeta['date'])
+            return self.captures.select('capture_of', capture_of)
+        else:
+            return self.captures.select()
 
     def wipe(self):
         self.resources.wipe()
@@ -56,10 +123,8 @@ class Registry:
         self.wipe_unused()
 
     def wipe_unused(self):
-        if self.unused_ids_path != None:
-            if not os.path.exists(self.unused_ids_path):
-                with open(self.unused_ids_path, 'w') as outfile:    # overwrite
-                    json.dump(initial_unused_ids, outfile, indent=1)
+        if self.allocator != None:
+            self.allocator.create(self.id_seed, self.reserved_ids)
 
 
 # Not used
@@ -116,69 +181,247 @@ def validate_capture(cmeta, registry):
 # Tables
         
 class Table:
-    def __init__(self, path):
+    # What the snapshot cache saves
+    cached_fields = ['index_by_name', 'index_by_id', 'signature']
+    cache_suffix = '.cache'
+
+    def __init__(self, path, cache=True):
         self.path = path
+        if cache:
+            self.cache_path = path + self.cache_suffix
+        else:
+            self.cache_path = None
         self.index_by_name = None
         self.index_by_id = None
-    def refresh(self):
+        self.views = {}         # field -> value -> DateView, built on demand
+        self.pending = []       # blobs put since last flush
+        self.signature = None   # identifies the version of the file we read
+    def load(self):
         if os.path.exists(self.path):
             with open(self.path) as infile:
                 print 'reading', self.path
-                bloblist = json.load(infile)
-                self.index_by_name = index_by_field(bloblist, 'name')
-                if bloblist[0].get('id') != None:
-                    self.index_by_id = index_by_field(bloblist, 'id')
+                # fstat, not stat: a writer may replace the file under us
+                self.signature = fileutil.stat_signature(os.fstat(infile.fileno()))
+                return json.load(infile)
         else:
-            self.index_by_name = {}
-            self.index_by_id = {}
+            self.signature = None
+            return []
+    def refresh(self):
+        if not self.load_cache():
+            self.rebuild()
+            self.save_cache()
+        self.views = {}
+        self.pending = []
+    def rebuild(self):
+        bloblist = self.load()
+        self.index_by_name = index_by_field(bloblist, 'name')
+        self.index_by_id = index_by_field(bloblist, 'id')
+
+    # Snapshot cache.  Parsing the indented JSON and building the
+    # indexes is most of the startup time of short commands, so the
+    # built indexes are pickled to <path>.cache, keyed on the stat
+    # signatures (inode, size, mtime) of the files they came from, and
+    # reused as long as those files haven't changed.
+
+    # Signatures of the source files as they are now
+    def cache_key(self):
+        return (fileutil.signature(self.path),)
+    # Signatures of the source files as they were when we read them;
+    # None if there was nothing to read
+    def loaded_key(self):
+        if self.signature == None:
+            return None
+        return (self.signature,)
+    def load_cache(self):
+        if self.cache_path == None or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'rb') as infile:
+                if cPickle.load(infile) != self.cache_key():
+                    return False
+                # One read, then unpickle from memory: much faster than
+                # letting cPickle make many small reads from the file
+                state = cPickle.loads(infile.read())
+            # All or nothing, so a bad cache can't leave the table half set
+            values = [state[field] for field in self.cached_fields]
+        except Exception, e:
+            # Truncated or stale pickles fail in all sorts of ways
+            # (ValueError, ImportError, KeyError, ...); just reread
+            print '** unreadable cache', self.cache_path, repr(e)
+            return False
+        for (field, value) in zip(self.cached_fields, values):
+            setattr(self, field, value)
+        return True
+    def save_cache(self):
+        key = self.loaded_key()
+        if self.cache_path == None or key == None:
+            return
+        state = {}
+        for field in self.cached_fields:
+            state[field] = getattr(self, field)
+        try:
+            with fileutil.atomic_write(self.cache_path) as outfile:
+                cPickle.dump(key, outfile, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(state, outfile, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError), e:
+            print '** could not write cache', self.cache_path, e
     def swapin(self):
         if self.index_by_name == None:
             self.refresh()
+    # Readers don't lock; writers hold the table's lock from the check
+    # for changes made by other processes through the replacement of
+    # the file.
     def flush(self):
+        if self.index_by_name == None:
+            return              # nothing loaded, nothing to write
+        with fileutil.locked(self.path):
+            if fileutil.signature(self.path) != self.signature:
+                self.merge()
+            self.dump(self.path)
+            self.signature = fileutil.signature(self.path)
+        self.pending = []
+    # Someone else wrote the table since we read it.  Re-read it and
+    # redo our puts on top, so conflicts get reported, not clobbered.
+    def merge(self):
+        print 'table changed since read, merging', self.path
+        pending = self.pending
+        self.refresh()
+        for blob in pending:
+            self.put(blob['name'], blob)
+    def dump(self, path):
         bloblist = sorted(self.index_by_name.values(), key=lambda dict:dict["date"])
-        with open(self.path, 'w') as outfile:
-            # print 'writing', self.path
+        with fileutil.atomic_write(path) as outfile:
+            # print 'writing', path
             json.dump(bloblist, outfile, indent=2)
+    def abort(self):
+        # Forget unflushed puts; next access re-reads the file
+        self.index_by_name = None
+        self.index_by_id = None
+        self.views = {}
+        self.pending = []
 
     def values(self):
         self.swapin()
         return self.index_by_name.values()
     def get(self, name):
         self.swapin()
-        if self.index_by_name == None:
-            self.refresh()
         return self.index_by_name.get(name)
     def get_by_id(self, id):
         self.swapin()
-        return self.index_by_name.get(name)
+        return self.index_by_id.get(id)
+    # Blobs in date order, optionally only those with blob[field] == value.
+    # The first select on a field groups the table by that field; after
+    # that put keeps the groups up to date, so a select costs O(k).
+    def select(self, field=None, value=None):
+        view = self.view(field).get(value)
+        if view == None:
+            return []
+        return list(view.blobs)
+    def view(self, field):
+        self.swapin()
+        views = self.views.get(field)
+        if views == None:
+            groups = {}
+            for blob in self.index_by_name.values():
+                if field != None:
+                    key = blob.get(field)
+                else:
+                    key = None
+                groups.setdefault(key, []).append(blob)
+            views = {}
+            for key in groups:
+                views[key] = DateView(groups[key])
+            self.views[field] = views
+        return views
     def put(self, name, blob):
         self.swapin()
         # See if blob is already in table
         name = blob['name']
         oldblob = self.index_by_name.get(name)
         if oldblob != None:
-            for key in blob:
-                if key in oldblob:
-                    if blob[key] != oldblob[key]:
-                        print '** Cannot change registered info!', name, key
-                        return False
-                else:
-                    print '** Cannot add info to registration!', name, key
-                    return False
-            return True
+            return compatible(oldblob, blob)
+        elif 'id' in blob and blob['id'] in self.index_by_id:
+            print '** Id already registered!', name, blob['id'], \
+                self.index_by_id[blob['id']]['name']
+            return False
         else:
             self.index_by_name[name] = blob
             if 'id' in blob: self.index_by_id[blob['id']] = blob
+            self.add_to_views(blob)
+            self.pending.append(blob)
             # Not very safe!  This is just a prototype, fix later
             return True
+    def add_to_views(self, blob):
+        for field in self.views:
+            if field != None:
+                key = blob.get(field)
+            else:
+                key = None
+            views = self.views[field]
+            if not key in views:
+                views[key] = DateView([])
+            views[key].add(blob)
     def wipe(self):
-        if os.path.exists(self.path):
-            os.remove(self.path)
+        for path in [self.path, self.cache_path]:
+            if path != None and os.path.exists(path):
+                os.remove(path)
         self.index_by_name = None
         self.index_by_id = None
+        self.views = {}
+        self.pending = []
+        self.signature = None
+
+# List of blobs kept sorted by date, with insertion in O(log n) compares
+
+class DateView:
+    def __init__(self, blobs):
+        self.blobs = sorted(blobs, key=lambda blob:blob['date'])
+        self.dates = [blob['date'] for blob in self.blobs]
+    def add(self, blob):
+        i = bisect.bisect_right(self.dates, blob['date'])
+        self.dates.insert(i, blob['date'])
+        self.blobs.insert(i, blob)
+
+# A blob may be put again only if it says nothing new
+
+def compatible(oldblob, blob):
+    name = blob['name']
+    for key in blob:
+        if key in oldblob:
+            if blob[key] != oldblob[key]:
+                print '** Cannot change registered info!', name, key
+                return False
+        else:
+            print '** Cannot add info to registration!', name, key
+            return False
+    return True
+
+# Choose a storage engine for a table.  'json' (the default) keeps the
+# whole table in one JSON file; 'journal' appends puts to a log next
+# to it (see journal.py); 'sqlite' keeps it in an indexed SQLite
+# database (see sqltable.py); 'lazy' reads the JSON file but decodes
+# records only when they're asked for (see lazytable.py).
+
+def make_table(path, storage=None):
+    if storage == None or storage == 'json':
+        return Table(path)
+    elif storage == 'journal':
+        import journal
+        return journal.JournalTable(path)
+    elif storage == 'sqlite':
+        import sqltable
+        return sqltable.SqliteTable(path)
+    elif storage == 'lazy':
+        import lazytable
+        return lazytable.LazyTable(path)
+    else:
+        raise ValueError('unknown table storage: %s' % storage)
+
+# Blobs without the field are left out
 
 def index_by_field(dict_list, key):
     index = {}
     for d in dict_list:
-        index[d[key]] = d
+        if key in d:
+            index[d[key]] = d
     return index
@@ -0,0 +1,182 @@
+# Choosing which location to fetch a capture from.
+
+# Each location is charged an estimated cost in seconds, latency plus
+# bytes / throughput, from statistics kept across audit runs under a
+# key for the kind of location and, for remote ones, the host
+# ('repo', 'local', 'http:files.opentreeoflife.org', 'ssh:varela'):
+# transfers done by audit --execute contribute throughput, and HEAD
+# probes contribute latency.  Hosts we know nothing about get default
+# costs by kind of location, which give the old fixed order: elsewhere
+# in the repo, then local files, then http, then ssh.
+
+# Failures are charged to whatever failed.  Only failing to reach a
+# remote host at all (connection refused, timeout, unknown name) counts
+# against the host; a remote host that has failed that way several
+# times in a row recently is taken to be dead and its locations are
+# skipped.  Anything else (a 404, a download that fails its size or
+# digest check) counts against just that one location, which is
+# likewise skipped after several failures in a row.  Failures of local
+# commands (mv, tarball.py) say nothing about where the file came from
+# and aren't counted at all.
+
+import os, json, time, urlparse
+import fileutil
+
+default_stats_name = 'transfer_stats.json'
+
+# Latency (s) and throughput (bytes/s) assumed for a host with no history
+default_costs = {'repo': (0.0, 1e12),
+                 'local': (0.001, 200e6),
+                 'http': (0.5, 5e6),
+                 'ssh': (1.0, 5e6)}
+kinds = ['repo', 'local', 'http', 'ssh']
+remote_kinds = ['http', 'ssh']
+
+alpha = 0.3                     # weight of newest sample in the averages
+min_throughput_bytes = 1 << 20  # smaller transfers say little about throughput
+dead_after = 3                  # consecutive failures
+dead_for = 24 * 3600            # seconds before trying a dead host or location again
+unknown_size = 1 << 20          # bytes assumed for a capture without 'bytes'
+
+# Kind of location
+
+def location_kind(loc, prefix):
+    if '://' in loc:
+        return 'http'
+    elif ':' in loc:
+        if loc.startswith(prefix):
+            return 'local'
+        else:
+            return 'ssh'
+    else:
+        return 'repo'
+
+# Key that statistics for loc are kept under
+
+def location_key(loc, prefix):
+    kind = location_kind(loc, prefix)
+    if kind == 'http':
+        return 'http:' + urlparse.urlparse(loc).netloc
+    elif kind == 'ssh':
+        return 'ssh:' + loc.split(':', 1)[0]
+    else:
+        return kind
+
+def is_remote(key):
+    return key.split(':', 1)[0] in remote_kinds
+
+class SourceStats:
+    def __init__(self, path):
+        self.path = path
+        self.hosts = {}
+        if path != None and os.path.exists(path):
+            with open(path) as infile:
+                self.hosts = json.load(infile)
+        self.changed = False
+
+    def host(self, host):
+        return self.hosts.setdefault(host, {'transfers': 0, 'bytes': 0, 'seconds': 0.0,
+                                            'failures': 0})
+
+    # A transfer from loc (whose key is host).  unreachable says that
+    # it failed because the host couldn't be reached.
+    def record_transfer(self, host, loc, nbytes, seconds, ok, unreachable=False):
+        h = self.host(host)
+        if ok:
+            h['transfers'] += 1
+            h['failures'] = 0
+            self.record_location_ok(host, loc)
+            if nbytes != None:
+                h['bytes'] += nbytes
+                h['seconds'] += seconds
+                if nbytes >= min_throughput_bytes and seconds > 0:
+                    h['throughput'] = average(h.get('throughput'), nbytes / seconds)
+                else:
+                    h['latency'] = average(h.get('latency'), seconds)
+        elif unreachable:
+            self.record_failure(host)
+        else:
+            self.record_location_failure(host, loc)
+        self.changed = True
+
+    def record_latency(self, host, seconds):
+        h = self.host(host)
+        h['latency'] = average(h.get('latency'), seconds)
+        h['failures'] = 0
+        self.changed = True
+
+    # Couldn't reach the host
+    def record_failure(self, host):
+        if not is_remote(host):
+            return
+        h = self.host(host)
+        h['failures'] += 1
+        h['last_failure'] = time.time()
+        self.changed = True
+
+    # Reached the host, but loc wasn't there or wasn't right
+    def record_location_failure(self, host, loc):
+        if not is_remote(host):
+            return
+        locations = self.host(host).setdefault('locations', {})
+        l = locations.setdefault(loc, {'failures': 0})
+        l['failures'] += 1
+        l['last_failure'] = time.time()
+        self.changed = True
+
+    def record_location_ok(self, host, loc):
+        h = self.hosts.get(host)
+        if h != None and loc in h.get('locations', {}):
+            del h['locations'][loc]
+            self.changed = True
+
+    def is_dead(self, host):
+        h = self.hosts.get(host)
+        return (is_remote(host) and h != None and recently_failed(h))
+
+    def is_dead_location(self, host, loc):
+        h = self.hosts.get(host)
+        return (is_remote(host) and h != None and
+                recently_failed(h.get('locations', {}).get(loc)))
+
+    # Estimated seconds to fetch nbytes from loc
+    def cost(self, loc, nbytes, prefix):
+        (latency, throughput) = default_costs[location_kind(loc, prefix)]
+        h = self.hosts.get(location_key(loc, prefix))
+        if h != None:
+            latency = h.get('latency', latency)
+            throughput = h.get('throughput', throughput)
+        return latency + nbytes / throughput
+
+    # Locations cheapest first, leaving out dead ones and those on dead
+    # hosts
+    def order(self, locations, cmeta, prefix):
+        nbytes = cmeta.get('bytes', unknown_size)
+        live = []
+        for loc in locations:
+            host = location_key(loc, prefix)
+            if self.is_dead(host):
+                print '** skipping location on dead host:', loc
+            elif self.is_dead_location(host, loc):
+                print '** skipping location that has failed repeatedly:', loc
+            else:
+                live.append(loc)
+        def key(loc):
+            return (self.cost(loc, nbytes, prefix),
+                    kinds.index(location_kind(loc, prefix)))
+        return sorted(live, key=key)
+
+    def save(self):
+        if self.changed and self.path != None:
+            with fileutil.atomic_write(self.path) as outfile:
+                json.dump(self.hosts, outfile, indent=1, sort_keys=True)
+            self.changed = False
+
+def recently_failed(h):
+    return (h != None and h['failures'] >= dead_after and
+            time.time() - h.get('last_failure', 0) < dead_for)
+
+def average(old, new):
+    if old == None:
+        return new
+    return alpha * new + (1 - alpha) * old
@@ -0,0 +1,140 @@
+# SQLite storage for registry tables.
+
+# Same contract as registry.Table (get / get_by_id / put / values /
+# select / flush / abort / wipe), but blobs live in an SQLite database
+# with indexes on name, id, capture_of and date, so get_resource and
+# all_captures(capture_of) are index lookups rather than a load of the
+# whole table.  The database is in WAL mode, so readers in other
+# processes see the last committed state and are not blocked while one
+# process registers.
+
+# Given a .json table path, the database goes next to it with suffix
+# .sqlite, and is initialized from the JSON file if that exists.
+
+# python sqltable.py export var/recap/initial_captures.json captures.json
+
+import os, sys, json, sqlite3, registry
+
+schema = """
+create table if not exists blobs (
+    name text primary key,
+    id integer,
+    capture_of text,
+    date text,
+    blob text not null
+);
+create index if not exists blobs_id on blobs (id);
+create index if not exists blobs_capture_of on blobs (capture_of, date);
+create index if not exists blobs_date on blobs (date);
+"""
+
+# Columns that can be used in select(); all others are inside the blob
+indexed_fields = ['name', 'id', 'capture_of', 'date']
+
+class SqliteTable:
+    def __init__(self, path):
+        (stem, ext) = os.path.splitext(path)
+        if ext == '.json':
+            self.json_path = path
+            self.path = stem + '.sqlite'
+        else:
+            self.json_path = None
+            self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection == None:
+            new = not os.path.exists(self.path)
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('pragma journal_mode=wal')
+            self.connection.executescript(schema)
+            if new and self.json_path != None and os.path.exists(self.json_path):
+                self.import_json(self.json_path)
+        return self.connection
+
+    def query(self, sql, params=()):
+        return [json.loads(row[0])
+                for row in self.connect().execute(sql, params)]
+
+    def get(self, name):
+        blobs = self.query('select blob from blobs where name = ?', (name,))
+        if len(blobs) > 0: return blobs[0]
+        return None
+
+    def get_by_id(self, id):
+        blobs = self.query('select blob from blobs where id = ?', (id,))
+        if len(blobs) > 0: return blobs[0]
+        return None
+
+    def values(self):
+        return self.query('select blob from blobs')
+
+    def select(self, field=None, value=None):
+        if field == None:
+            return self.query('select blob from blobs order by date')
+        if not field in indexed_fields:
+            raise ValueError('not an indexed field: %s' % field)
+        return self.query('select blob from blobs where %s = ? order by date' % field,
+                          (value,))
+
+    def put(self, name, blob):
+        name = blob['name']
+        oldblob = self.get(name)
+        if oldblob != None:
+            return registry.compatible(oldblob, blob)
+        if 'id' in blob:
+            other = self.get_by_id(blob['id'])
+            if other != None:
+                print '** Id already registered!', name, blob['id'], other['name']
+                return False
+        self.connect().execute(
+            'insert into blobs (name, id, capture_of, date, blob) values (?, ?, ?, ?, ?)',
+            (name, blob.get('id'), blob.get('capture_of'), blob.get('date'),
+             json.dumps(blob, sort_keys=True)))
+        return True
+
+    # Puts are held in an open transaction until flush
+    def flush(self):
+        if self.connection != None:
+            self.connection.commit()
+
+    def abort(self):
+        if self.connection != None:
+            self.connection.rollback()
+
+    def refresh(self):
+        # Nothing cached; every read goes to the database
+        pass
+
+    def wipe(self):
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        # Don't re-import the JSON file after an explicit wipe
+        self.json_path = None
+
+    def import_json(self, path):
+        print 'importing', path
+        with open(path) as infile:
+            for blob in json.load(infile):
+                self.put(blob['name'], blob)
+        self.flush()
+
+    # Plain JSON copy of the table, readable by registry.Table
+    def export(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.select(), outfile, indent=2)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    table = SqliteTable(sys.argv[2])
+    if command == 'export':
+        table.export(sys.argv[3])
+    elif command == 'import':
+        table.import_json(sys.argv[3])
+    else:
+        print '** unrecognized command', command
@@ -0,0 +1,162 @@
+# Packing a directory capture into a .tgz.
+
+# Replaces the old make-tarball script (tar cvzf --dereference).  The
+# archive is reproducible: members are added in sorted order, links
+# are followed, and owners and times are normalized, so the same
+# directory always gives the same bytes (and the same sha256).  The
+# tar stream is cut into blocks that are gzipped in parallel on a
+# pool of processes, pigz-style; each block becomes a complete gzip
+# member, and gunzip (or Python's gzip module) reads the concatenation
+# as one file.  Since no member depends on the one before, a reader
+# can also start decompressing at any member boundary.
+
+# As with make-tarball, members are under a directory named after the
+# target, e.g. ncbi-20130227.tgz contains ncbi-20130227/...
+
+# python tarball.py sourcedir version/target.tgz
+
+import os, sys, stat, struct, zlib, hashlib, tarfile, argparse
+from multiprocessing import Pool, cpu_count
+import fileutil
+
+block_size = 1 << 20            # uncompressed bytes per gzip member
+level = 6
+default_mtime = 0
+
+# Returns (size, sha256) of the tarball written to dst
+
+def make_tarball(src, dst, jobs=None, mtime=default_mtime):
+    if not os.path.isdir(src):
+        raise ValueError('expected directory: %s' % src)
+    if os.path.exists(dst):
+        raise ValueError('expected nonexistent: %s' % dst)
+    versiondir = os.path.dirname(os.path.abspath(dst))
+    if not os.path.isdir(versiondir):
+        raise ValueError('expected directory: %s' % versiondir)
+    stem = os.path.basename(dst)
+    if stem.endswith('.tgz'):
+        stem = stem[0:-4]
+    with fileutil.atomic_write(dst) as outfile:
+        writer = BlockWriter(outfile, jobs)
+        try:
+            tar = tarfile.open(fileobj=writer, mode='w|', format=tarfile.GNU_FORMAT)
+            add_tree(tar, src, stem, mtime)
+            tar.close()
+            writer.close()
+        finally:
+            writer.terminate()
+    return (writer.size, writer.hash.hexdigest())
+
+# Directory entry first, then its contents in name order
+
+def add_tree(tar, path, arcname, mtime):
+    st = os.stat(path)
+    info = tarinfo(arcname, st, mtime)
+    if info.isdir():
+        tar.addfile(info)
+        for name in sorted(os.listdir(path)):
+            add_tree(tar, os.path.join(path, name), arcname + '/' + name, mtime)
+    elif info.isreg():
+        with open(path, 'rb') as infile:
+            tar.addfile(info, infile)
+    else:
+        print '** not a file or directory, leaving it out:', path
+
+def tarinfo(arcname, st, mtime):
+    info = tarfile.TarInfo(arcname)
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISREG(st.st_mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    else:
+        info.type = tarfile.FIFOTYPE    # anything; it gets left out
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+# File-like object for tarfile to write to.  Full blocks go to the pool
+# as soon as they're ready; compressed blocks are written out in order,
+# with only a few in flight at a time.
+
+class BlockWriter:
+    def __init__(self, outfile, jobs):
+        self.outfile = outfile
+        self.pool = None
+        if jobs == None:
+            jobs = cpu_count()
+        if jobs > 1:
+            self.pool = Pool(jobs)
+        self.max_pending = 2 * jobs
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        while self.buffered >= block_size:
+            data = ''.join(self.buffer)
+            self.buffer = [data[block_size:]]
+            self.buffered = len(self.buffer[0])
+            self.submit(data[0:block_size])
+
+    def submit(self, block):
+        if self.pool == None:
+            self.emit(gzip_member(block))
+            return
+        self.pending.append(self.pool.apply_async(gzip_member, (block,)))
+        while len(self.pending) >= self.max_pending:
+            self.emit(self.pending.pop(0).get())
+
+    def emit(self, member):
+        self.outfile.write(member)
+        self.hash.update(member)
+        self.size += len(member)
+
+    def close(self):
+        if self.buffered > 0:
+            self.submit(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while len(self.pending) > 0:
+            self.emit(self.pending.pop(0).get())
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool = None
+
+# One complete gzip member (RFC 1952) with no name and mtime 0
+
+gzip_header = struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, 0, 255)
+
+def gzip_member(data):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return ''.join([gzip_header,
+                    compressor.compress(data),
+                    compressor.flush(),
+                    struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                len(data) & 0xffffffff)])
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('src', help='directory to pack')
+    p.add_argument('dst', help='version/target.tgz')
+    p.add_argument('--jobs', type=int, help='compression processes, default one per core')
+    args = p.parse_args()
+    try:
+        (size, sha256) = make_tarball(args.src, args.dst, args.jobs)
+    except ValueError, e:
+        print '**', e
+        sys.exit(1)
+    print args.dst, size, 'bytes', 'sha256', sha256
@@ -0,0 +1,96 @@
+# Tests for probe.py, against a stand-in server on localhost.
+
+# cd recap; python -m unittest test_probe
+
+import socket, threading, unittest, BaseHTTPServer, SocketServer
+import probe
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        if self.path == '/moved':
+            # The redirect itself has a length; its target doesn't
+            self.send_response(301)
+            self.send_header('Location', '/unsized')
+            self.send_header('Content-Length', '178')
+            self.send_header('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        elif self.path == '/unsized':
+            self.send_response(200)
+        elif self.path == '/sized':
+            self.send_response(200)
+            self.send_header('Content-Length', '42')
+            self.send_header('Last-Modified', 'Tue, 02 Jan 2018 00:00:00 GMT')
+        elif self.path == '/loop':
+            self.send_response(302)
+            self.send_header('Location', '/loop')
+        else:
+            self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ProbeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(('127.0.0.1', 0), Handler)
+        cls.base = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def probe(self, path):
+        url = self.base + path
+        return probe.probe_urls([url], timeout=5)[url]
+
+    def test_sized(self):
+        p = self.probe('/sized')
+        self.assertTrue(p.ok())
+        self.assertEqual(p.length, 42)
+        self.assertEqual(p.last_modified, 'Tue, 02 Jan 2018 00:00:00 GMT')
+
+    def test_redirect_to_missing_length(self):
+        p = self.probe('/moved')
+        self.assertTrue(p.ok())
+        self.assertEqual(p.location, self.base + '/unsized')
+        self.assertEqual(p.length, None)
+        self.assertEqual(p.last_modified, None)
+
+    def test_not_found(self):
+        p = self.probe('/missing')
+        self.assertFalse(p.ok())
+        self.assertEqual(p.status, 404)
+        self.assertEqual(p.error, None)
+        self.assertFalse(p.unreachable)
+
+    def test_redirect_loop(self):
+        p = self.probe('/loop')
+        self.assertFalse(p.ok())
+        self.assertEqual(p.error, 'too many redirects')
+
+    def test_many_on_one_host(self):
+        urls = [self.base + path for path in ['/sized', '/moved', '/missing'] * 5]
+        probes = probe.probe_urls(urls, per_host=2, timeout=5)
+        self.assertEqual([probes[url].status for url in urls], [200, 200, 404] * 5)
+
+    def test_unreachable(self):
+        # A port nothing is listening on
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        url = 'http://127.0.0.1:%s/sized' % port
+        p = probe.probe_urls([url], timeout=5)[url]
+        self.assertFalse(p.ok())
+        self.assertTrue(p.unreachable)
+
+
+if __name__ == '__main__':
+    unittest.main()
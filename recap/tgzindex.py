@@ -0,0 +1,359 @@
+# Reading single members out of a capture .tgz without unpacking it.
+
+# The index for x.tgz is kept next to it in x.tgz.idx.json.  It has
+# the offset and size of every file in the uncompressed tar stream,
+# and a list of checkpoints at which decompression can start afresh.
+# To read a member we seek to the last checkpoint before it, decompress
+# from there, and skip to the member's data.
+
+# There are two kinds of checkpoint:
+#   [compressed offset, uncompressed offset]
+#       the start of a gzip member.  Tarballs made by tarball.py have
+#       one every megabyte of tar.
+#   [compressed offset, uncompressed offset, bits, window]
+#       a deflate block boundary inside a member, as in zlib's
+#       examples/zran.c: the boundary falls bits bits before the end of
+#       the byte at compressed offset - 1 (0 means on the byte
+#       boundary), and window is the 32K of tar before it, which the
+#       following blocks may refer back to (compressed, then base64).
+# A tarball made by plain tar czf is a single gzip member, so it gets
+# the second kind, one every checkpoint_span bytes of tar.
+
+# Python 2's zlib can neither stop at a block boundary nor start at one
+# with a preset dictionary, so for those we go to libz through ctypes.
+# Without libz, indexing records member boundaries only, and reading
+# ignores block checkpoints - still no unpacking to disk, but a single
+# member tarball is always read from the beginning.
+
+# The index records the size and mtime of the .tgz, and is rebuilt if
+# they change or it was made by an older version of this module.
+
+# python tgzindex.py index x.tgz
+# python tgzindex.py list x.tgz
+# python tgzindex.py cat x.tgz member
+
+import os, sys, io, json, zlib, bisect, tarfile, base64, ctypes, ctypes.util
+import fileutil
+
+index_suffix = '.idx.json'
+index_version = 2
+read_size = 1 << 20
+gzip_wbits = 16 + zlib.MAX_WBITS
+window_size = 1 << 15
+checkpoint_span = 1 << 23
+
+def index_path(tgz):
+    return tgz + index_suffix
+
+# Returns the index for tgz, making it (and saving it, if possible) if
+# there isn't an up to date one
+
+def load_index(tgz):
+    st = os.stat(tgz)
+    ipath = index_path(tgz)
+    if os.path.exists(ipath):
+        with open(ipath) as infile:
+            index = json.load(infile)
+        if (index.get('version') == index_version and
+            index['size'] == st.st_size and index['mtime'] == st.st_mtime):
+            return index
+    print >>sys.stderr, 'indexing', tgz
+    index = make_index(tgz)
+    try:
+        with fileutil.atomic_write(ipath) as outfile:
+            json.dump(index, outfile)
+    except (IOError, OSError), e:
+        print >>sys.stderr, '** could not save index', ipath, e
+    return index
+
+def make_index(tgz):
+    st = os.stat(tgz)
+    members = []
+    with open(tgz, 'rb') as infile:
+        stream = GunzipStream(infile, [0, 0], checkpoints=[])
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        for info in tar:
+            if info.isreg():
+                members.append((info.name, info.offset_data, info.size))
+        # Read to the end, so the last checkpoints get recorded
+        while stream.read(read_size):
+            pass
+    return {'version': index_version,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'checkpoints': stream.checkpoints,
+            'members': members}
+
+def member_names(index):
+    return [name for (name, offset, size) in index['members']]
+
+# Returns a file-like object (readable, iterable by lines) for the
+# contents of one member
+
+def open_member(tgz, name, index=None):
+    if index == None:
+        index = load_index(tgz)
+    for (mname, offset, size) in index['members']:
+        if mname == name:
+            return io.BufferedReader(MemberStream(tgz, index['checkpoints'], offset, size),
+                                     read_size)
+    raise KeyError(name)
+
+class MemberStream(io.RawIOBase):
+    def __init__(self, tgz, checkpoints, offset, size):
+        if libz == None:
+            checkpoints = [c for c in checkpoints if len(c) == 2]
+        uncomp_offsets = [c[1] for c in checkpoints]
+        checkpoint = checkpoints[bisect.bisect_right(uncomp_offsets, offset) - 1]
+        self.infile = open(tgz, 'rb')
+        self.stream = GunzipStream(self.infile, checkpoint)
+        self.stream.skip(offset - checkpoint[1])
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(min(len(b), self.remaining))
+        self.remaining -= len(data)
+        b[0:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.infile.close()
+        io.RawIOBase.close(self)
+
+# Decompresses a series of gzip members, starting at a checkpoint (see
+# above).  If checkpoints is a list, a checkpoint for the start of
+# every member is appended to it, and, with libz, one for a block
+# boundary whenever there's been no checkpoint for checkpoint_span
+# bytes.
+
+class GunzipStream:
+    def __init__(self, infile, checkpoint, checkpoints=None):
+        (comp_off, uncomp_off) = checkpoint[:2]
+        self.infile = infile
+        self.comp_off = comp_off        # of next byte to be read from infile
+        self.uncomp_off = uncomp_off    # of next byte to be returned
+        self.checkpoints = checkpoints
+        self.buffer = ''
+        self.pos = 0                    # of next byte to be returned, in buffer
+        if len(checkpoint) > 2:
+            (bits, window) = checkpoint[2:]
+            self.decompressor = Inflater(-zlib.MAX_WBITS)
+            if bits:
+                infile.seek(comp_off - 1)
+                self.decompressor.prime(bits, ord(infile.read(1)) >> (8 - bits))
+            else:
+                infile.seek(comp_off)
+            self.decompressor.set_dictionary(decode_window(window))
+        else:
+            infile.seek(comp_off)
+            self.start_member(comp_off, uncomp_off)
+
+    def start_member(self, comp_off, uncomp_off):
+        if self.checkpoints != None:
+            self.checkpoints.append([comp_off, uncomp_off])
+            self.last_checkpoint = uncomp_off
+            if libz != None:
+                self.decompressor = Inflater(gzip_wbits, self.at_block)
+                return
+        self.decompressor = zlib.decompressobj(gzip_wbits)
+
+    # Called by the Inflater at each block boundary while indexing;
+    # consumed and produced are counted from the start of the data it
+    # was given
+    def at_block(self, consumed, produced, bits, window):
+        uncomp_off = self.piece_start[1] + produced
+        if uncomp_off - self.last_checkpoint >= checkpoint_span:
+            self.checkpoints.append([self.piece_start[0] + consumed, uncomp_off,
+                                     bits, encode_window(window)])
+            self.last_checkpoint = uncomp_off
+
+    def fill(self):
+        data = self.infile.read(read_size)
+        if not data:
+            return False
+        self.comp_off += len(data)
+        pieces = [self.buffer[self.pos:]]
+        end = self.uncomp_off + len(pieces[0])
+        while data:
+            self.piece_start = (self.comp_off - len(data), end)
+            piece = self.decompressor.decompress(data)
+            pieces.append(piece)
+            end += len(piece)
+            data = self.decompressor.unused_data
+            if data:
+                # End of a gzip member; the rest is the next one
+                self.start_member(self.comp_off - len(data), end)
+        self.buffer = ''.join(pieces)
+        self.pos = 0
+        return True
+
+    def read(self, n=-1):
+        while n < 0 or len(self.buffer) - self.pos < n:
+            if not self.fill():
+                break
+        if n < 0:
+            n = len(self.buffer) - self.pos
+        data = self.buffer[self.pos:self.pos + n]
+        self.pos += len(data)
+        self.uncomp_off += len(data)
+        return data
+
+    def skip(self, n):
+        while n > 0:
+            data = self.read(min(n, read_size))
+            if not data:
+                break
+            n -= len(data)
+
+def encode_window(window):
+    return base64.b64encode(zlib.compress(window))
+
+def decode_window(s):
+    return zlib.decompress(base64.b64decode(s))
+
+# zlib's inflate, through ctypes.  Used like a zlib.decompressobj
+# (decompress, unused_data), and it can also be started partway into
+# a deflate stream (prime, set_dictionary) and report block boundaries
+# as it passes them: at_block(consumed, produced, bits, window), where
+# window is the last 32K of the member's output.
+
+# With raw deflate (negative wbits) the gzip trailer that follows the
+# stream is skipped, so that unused_data starts at the next member.
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+gzip_trailer_size = 8
+
+class ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+def load_libz():
+    path = ctypes.util.find_library('z')
+    if path == None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+        stream = ctypes.POINTER(ZStream)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.zlibVersion.argtypes = []
+        lib.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        lib.inflate.argtypes = [stream, ctypes.c_int]
+        lib.inflateEnd.argtypes = [stream]
+        lib.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+    except (OSError, AttributeError):
+        return None
+    return lib
+
+libz = load_libz()
+
+class Inflater:
+    def __init__(self, wbits, at_block=None):
+        self.stream = ZStream()
+        self.output = ctypes.create_string_buffer(read_size)
+        self.at_block = at_block
+        self.window = ''
+        self.finished = False
+        self.trailer = gzip_trailer_size if wbits < 0 else 0
+        self.unused_data = ''
+        self.check(libz.inflateInit2_(ctypes.byref(self.stream), wbits,
+                                      libz.zlibVersion(), ctypes.sizeof(ZStream)))
+
+    def __del__(self):
+        if libz != None and self.stream.state:
+            libz.inflateEnd(ctypes.byref(self.stream))
+
+    def check(self, status):
+        if status != Z_OK:
+            raise zlib.error('Error %s from libz: %s' % (status, self.stream.msg))
+
+    def prime(self, bits, value):
+        self.check(libz.inflatePrime(ctypes.byref(self.stream), bits, value))
+
+    def set_dictionary(self, window):
+        self.check(libz.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)))
+
+    def decompress(self, data):
+        if self.finished:
+            self.skip_trailer(data)
+            return ''
+        stream = self.stream
+        # data must stay put while inflate has a pointer into it
+        self.input = data
+        stream.next_in = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+        stream.avail_in = len(data)
+        out = ctypes.addressof(self.output)
+        flush = Z_NO_FLUSH if self.at_block == None else Z_BLOCK
+        pieces = []
+        produced = 0
+        while True:
+            stream.next_out = out
+            stream.avail_out = len(self.output)
+            status = libz.inflate(ctypes.byref(stream), flush)
+            if status not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                raise zlib.error('Error %s while decompressing: %s' % (status, stream.msg))
+            n = len(self.output) - stream.avail_out
+            if n > 0:
+                piece = ctypes.string_at(out, n)
+                pieces.append(piece)
+                produced += n
+                if self.at_block != None:
+                    self.window = (self.window + piece)[-window_size:]
+            if status == Z_STREAM_END:
+                self.finished = True
+                self.skip_trailer(data[len(data) - stream.avail_in:])
+                break
+            if self.at_block != None and stream.data_type & 128 and not stream.data_type & 64:
+                self.at_block(len(data) - stream.avail_in, produced,
+                              stream.data_type & 7, self.window)
+            if status == Z_BUF_ERROR or (stream.avail_in == 0 and stream.avail_out > 0):
+                break
+        self.input = None
+        return ''.join(pieces)
+
+    def skip_trailer(self, data):
+        skip = min(self.trailer, len(data))
+        self.trailer -= skip
+        self.unused_data += data[skip:]
+
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    tgz = sys.argv[2]
+    if command == 'index':
+        index = load_index(tgz)
+        print len(index['members']), 'members', len(index['checkpoints']), 'checkpoints'
+    elif command == 'list':
+        for name in member_names(load_index(tgz)):
+            print name
+    elif command == 'cat':
+        with open_member(tgz, sys.argv[3]) as infile:
+            while True:
+                data = infile.read(read_size)
+                if not data:
+                    break
+                sys.stdout.write(data)
+    else:
+        print '** unrecognized command', command
+        sys.exit(1)
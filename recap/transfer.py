@@ -0,0 +1,184 @@
+# Running the fix-up commands that audit generates.
+
+# Instead of piping audit's output to sh, which runs one command at a
+# time, audit --execute hands the fix-ups to execute() here.  Each
+# Fixup is the short list of commands for one capture (make the
+# directory, then fetch / move / tar), run in order; different fixups
+# run concurrently on a bounded number of threads, with a separate
+# limit on how many run at once against any one host, so a mirror
+# isn't hit with everything at once and slow hosts don't hold up fast
+# ones.  A failing command is retried with exponential backoff.
+
+import os, re, sys, time, threading, subprocess, urlparse
+import fetch
+
+default_transfers = 8
+default_per_host = 2
+default_retries = 3
+default_backoff = 5.0           # seconds before the first retry
+
+# Exit statuses that mean a command couldn't reach its host: fetch.py's,
+# and ssh's, which scp passes on
+unreachable_statuses = (fetch.unreachable_status, 255)
+
+class Fixup:
+    def __init__(self, name, commands, dst=None, location=None, source=None):
+        self.name = name
+        self.commands = commands
+        self.dst = dst              # file the commands produce
+        self.location = location    # where they get it from
+        self.source = source        # sources.location_key of location
+        self.host = commands_host(commands)
+        self.ok = None
+        self.status = None          # exit status of the last command run
+        self.seconds = None
+        self.bytes = None
+
+# Which host a fixup's transfer talks to; 'local' if none
+
+scp_pattern = re.compile(r'^scp(?: -\S+)* ([^ :/]+):')
+url_pattern = re.compile(r'"([a-z]+://[^"]+)"')
+
+def commands_host(commands):
+    for command in commands:
+        m = scp_pattern.match(command)
+        if m:
+            return m.group(1)
+        m = url_pattern.search(command)
+        if m:
+            return urlparse.urlparse(m.group(1)).netloc
+    return 'local'
+
+class Executor:
+    def __init__(self, transfers=default_transfers, per_host=default_per_host,
+                 retries=default_retries, backoff=default_backoff, local_limit=None,
+                 stats=None):
+        self.transfers = transfers
+        self.per_host = per_host
+        self.local_limit = local_limit or transfers
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = stats      # sources.SourceStats to learn from, or None
+        self.lock = threading.Condition()
+        self.pending = []
+        self.running = {}       # host -> number of fixups in progress
+        self.done = []
+        self.total = 0
+        self.start = None
+
+    def limit(self, host):
+        if host == 'local':
+            return self.local_limit
+        return self.per_host
+
+    # prep commands (e.g. making resource directories) run first, in
+    # order; then the fixups, concurrently.  Returns the failed fixups.
+    def execute(self, fixups, prep=[]):
+        self.start = time.time()
+        for command in prep:
+            if self.run_command(command) != 0:
+                print '** preparatory command failed, not continuing:', command
+                return fixups
+        self.pending = list(fixups)
+        self.total = len(fixups)
+        threads = [threading.Thread(target=self.worker)
+                   for i in range(min(self.transfers, len(fixups)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join with a timeout so that ^C still works
+            while thread.is_alive():
+                thread.join(1)
+        self.report()
+        if self.stats != None:
+            self.stats.save()
+        return [fixup for fixup in self.done if not fixup.ok]
+
+    def worker(self):
+        while True:
+            fixup = self.next_fixup()
+            if fixup == None:
+                return
+            self.run_fixup(fixup)
+            with self.lock:
+                self.running[fixup.host] -= 1
+                self.done.append(fixup)
+                if self.stats != None and fixup.source != None:
+                    self.stats.record_transfer(fixup.source, fixup.location, fixup.bytes,
+                                               fixup.seconds, fixup.ok,
+                                               fixup.status in unreachable_statuses)
+                self.progress(fixup)
+                self.lock.notify_all()
+
+    # First pending fixup whose host isn't at its limit; waits if all
+    # are; None when nothing is left
+    def next_fixup(self):
+        with self.lock:
+            while len(self.pending) > 0:
+                for (i, fixup) in enumerate(self.pending):
+                    if self.running.get(fixup.host, 0) < self.limit(fixup.host):
+                        del self.pending[i]
+                        self.running[fixup.host] = self.running.get(fixup.host, 0) + 1
+                        return fixup
+                self.lock.wait()
+            return None
+
+    def run_fixup(self, fixup):
+        start = time.time()
+        fixup.ok = True
+        for command in fixup.commands:
+            fixup.status = self.run_command(command)
+            if fixup.status != 0:
+                fixup.ok = False
+                break
+        fixup.seconds = time.time() - start
+        if fixup.ok and fixup.dst != None:
+            fixup.bytes = file_size(fixup.dst)
+
+    # Returns the exit status of the last attempt
+    def run_command(self, command):
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * (2 ** (attempt - 1))
+                print '** retrying in %gs: %s' % (delay, command)
+                time.sleep(delay)
+            status = subprocess.call(command, shell=True)
+            if status == 0:
+                return 0
+        print '** failed:', command
+        return status
+
+    def progress(self, fixup):
+        if fixup.ok:
+            status = 'ok'
+        else:
+            status = 'FAILED'
+        rate = ''
+        if fixup.bytes != None and fixup.seconds > 0:
+            rate = ' %s in %.1fs (%s/s)' % (human_bytes(fixup.bytes), fixup.seconds,
+                                            human_bytes(fixup.bytes / fixup.seconds))
+        print '[%d/%d] %s %s %s%s' % (len(self.done), self.total, status,
+                                      fixup.name, fixup.host, rate)
+        sys.stdout.flush()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        ok = [fixup for fixup in self.done if fixup.ok]
+        total_bytes = sum([fixup.bytes or 0 for fixup in ok])
+        print '%d of %d fixups done, %d failed, %s in %.1fs (%s/s)' % \
+            (len(ok), self.total, len(self.done) - len(ok), human_bytes(total_bytes),
+             elapsed, human_bytes(total_bytes / max(elapsed, 0.001)))
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def human_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return '%.1f%s' % (n, unit)
+        n = n / 1024.0
+    return '%.1fTB' % n
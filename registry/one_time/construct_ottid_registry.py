@@ -3,8 +3,9 @@
 #   - put stats in tabular form
 
 
-import sys, os, csv
-import recap.registry
+import sys, os, csv, gc, itertools, multiprocessing
+import recap.registry, recap.tgzindex
+import taxonomy_reader, idtables, equivalence_shards, ottid_index
 
 version_count = 3
 
@@ -15,115 +16,178 @@ versions = ['1.0', '2.0','2.1', '2.2', '2.3', '2.4',
 
 # versions2 = map(lambda v: v['relative_name'], artifact.load_artifacts(artifact.directory_path))
 
-def process_registry(start, count):
+# Processes count versions, starting with version number start (0 =
+# the first).  The state after each version is saved as a checkpoint,
+# and a run that doesn't start at the beginning picks up from the
+# checkpoint for the version before start.
+
+# Reading the taxonomies is done by a pool of jobs processes, running
+# ahead of the registry updates, which have to be done in order one
+# version at a time (see parse_version).
+
+# With shards > 1, the equivalences are kept in that many processes,
+# which do most of check_source_lists' work for each version between
+# them (see equivalence_shards.py).  The output is the same either way.
+
+def process_registry(start, count, jobs=None, shards=None):
     cmetas = recapreg.all_captures('ott')
     print len(cmetas), 'OTT versions'
-    registry = {}               # maps OTT id to TNU i.e. to (qid, capturename)
-    equivalences = {}           # maps qualified id to OTT id
+    sharded = shards != None and shards > 1
+    if start > 0:
+        previous = cmetas[start - 1]['name']
+        cpath = checkpoint_path(previous)
+        if not os.path.exists(cpath):
+            print '** no checkpoint for %s, need to process it first' % previous
+            return None
+        print 'loading', cpath
+        (name, registry, equivalences, coder) = idtables.load_state(cpath, not sharded)
+        if name != previous:
+            print '** checkpoint is for the wrong version', cpath, name
+            return None
+    else:
+        registry = idtables.IdTable()   # maps OTT id to TNU i.e. to (qid, capturename)
+        equivalences = {}           # maps qualified id to OTT id
+        coder = idtables.QidCoder() # qids in registry and equivalences are packed ints
+    if sharded:
+        equivalences = equivalence_shards.ShardedEquivalences(shards)
+        if start > 0:
+            equivalences.load(cpath)
     merges = {}                 # maps OTT id to OTT id
-    i = 0
     ott = {}
-    for ott_version in cmetas:
-        next_ott = register_one_version(ott_version, ott, registry, equivalences)
-        i += 1
-        if i >= count: break
+    checkpointing = True
+    todo = cmetas[start:start + count]
+    parse_jobs = [(ott_version, shards if sharded else None) for ott_version in todo]
+    pool = None
+    if jobs == 1:
+        parsed = itertools.imap(parse_version_job, parse_jobs)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        parsed = pool.imap(parse_version_job, parse_jobs)
+    # The equivalences grow to millions of entries, none of them in
+    # cycles, and the cycle collector would otherwise keep rescanning
+    # them as each version's rows are parsed and merged
+    gc.disable()
+    try:
+        for (ott_version, rpath) in itertools.izip(todo, parsed):
+            next_ott = register_one_version(ott_version, rpath, ott, registry, equivalences, coder)
+            if next_ott == None:
+                # Version was skipped; a checkpoint from here on would hide that
+                checkpointing = False
+            if checkpointing:
+                cpath = checkpoint_path(ott_version['name'])
+                print 'writing', cpath
+                idtables.save_state(cpath, ott_version['name'], registry, equivalences, coder)
+    finally:
+        gc.enable()
+        if pool != None:
+            pool.terminate()
+        if sharded:
+            equivalences.stop()
+    if checkpointing and todo:
+        # For looking ids up afterwards (see ottid_index.py)
+        ipath = index_path()
+        print 'writing', ipath
+        ottid_index.build(cpath, ipath)
     return registry
 
-def register_one_version(ott_version, previous_ott, registry, equivalences):
+def checkpoint_path(version_name):
+    return 'var/ottid_registry/%s-state.pickle' % version_name
+
+def index_path():
+    return 'var/ottid_registry/ottid-index.bin'
+
+# Runs in a worker process: reads one version's taxonomy and saves
+# the uid and source qids of each row, encoded, for
+# register_one_version.  With shards, the keys are split among them
+# too.  Returns the path they're saved in, or None.
+
+def parse_version(ott_version, shards=None):
+    # What would smasher do?
+    infile = open_taxonomy(ott_version)     # taxonomy.tsv
+    if infile == None:
+        # diagnostic has already been printed
+        return None
+    rows = idtables.Rows()
+    with infile:
+        # Each row is (id, source_list).  source_list is a list of qid.
+        # A qid is an (idspace, id) pair.
+        rows.add_all(taxonomy_reader.TaxonomyReader(infile))
+    if shards != None:
+        rows.partition(shards)
+    rpath = rows_path(ott_version['name'])
+    idtables.save_rows(rpath, rows)
+    return rpath
+
+# Pool.imap passes a single argument
+def parse_version_job(job):
+    return parse_version(*job)
+
+def rows_path(version_name):
+    return 'var/ottid_registry/%s-rows.tmp' % version_name
+
+def register_one_version(ott_version, rpath, previous_ott, registry, equivalences, coder):
     ott = {}
     ott_sources = ott_version['sources']  # maps idspace -> capture
-    # What would smasher do?
-    tpath = get_taxonomy_path(ott_version)   # path to taxonomy.tsv
-    if tpath == None:
+    if rpath == None:
         # diagnostic has already been printed
         return
-    size_before = len(registry)
-    print 'reading', tpath
-    with open(tpath, 'r') as infile:
-        sep = '\t|\t'
-        header = infile.next().split(sep)
-        def get_col(name):
-            if name in header:
-                return header.index(name)
-            else:
-                return None
-        uid_col = get_col('uid')
-        source_col = get_col('source')
-        sourceid_col = get_col('sourceid')
-        sourceinfo_col = get_col('sourceinfo')
-        name_col = get_col('name')
-        # Returns list of qid.  A qid is an (idspace, id) pair.
-        def get_source_list(row):
-            if source_col != None:
-                return [(row[source_col], row[sourceid_col])]
-            else:
-                sourceinfo = row[sourceinfo_col]
-                source_list = []
-                for qid in sourceinfo.split(','):
-                    if qid.startswith('http'):
-                        source_list.append((qid, row[name_col]))
-                    else:
-                        s = qid.split(':', 1)
-                        idspace = s[0]
-                        if len(s) > 1:
-                            source_list.append((idspace, s[1]))
-                        else:
-                            print row
-                            source_list.append((idspace, row[name_col]))
-                return source_list
-        novel = {}    # New ids in this OTT version
-        changes = []
-        for line in infile:
-            row = line.split(sep)
-            # 0=uid	|	1=parent_uid	|	2=name	|	3=rank	|	4=source	|	5=sourceid	|	sourcepid	|	uniqname	|	preottol_id	|	
-            id = int(row[uid_col])
-            source_list = get_source_list(row)
-            registration = registry.get(id)
-            if registration == None:
-                # New registration
-                registered_qid = source_list[0]
-                (idspace, _) = registered_qid
-                capture_name = ott_sources.get(idspace)
-                if capture_name == None:
-                    # Probably comes from one of the patch files!
-                    capture_name = idspace
-                tnu = (registered_qid, capture_name)
-                novel[id] = tnu
-                registry[id] = tnu
-            change = check_source_list(source_list, id, equivalences, changes)
+    rows = idtables.load_rows(rpath, coder)
+    os.remove(rpath)
+    changes = []
+    sharded = isinstance(equivalences, equivalence_shards.ShardedEquivalences)
+    if sharded:
+        equivalences.start_update(rows)
+    def capture_of(idspace):
+        capture_name = ott_sources.get(idspace)
+        if capture_name == None:
+            # Probably comes from one of the patch files!
+            capture_name = idspace
+        return capture_name
+    # New registrations: new ids in this OTT version
+    novel = registry.register_new(rows.uids, rows.first_keys(), coder, capture_of)
+    if sharded:
+        equivalences.finish_update(rows, changes, coder)
+    else:
+        check_source_lists(rows, equivalences, changes, coder)
 
     print ' added', len(novel), 'ids'
-    write_registry(novel, 'var/ottid_registry/%s-ids.csv' % ott_version['name'])
+    write_registry(registry, novel, coder, 'var/ottid_registry/%s-ids.csv' % ott_version['name'])
     write_changes(changes, 'var/ottid_registry/%s-changes.csv' % ott_version['name'])
+    return ott
 
-def check_source_list(source_list, id, equivalences, changes):
-    # Update equivalences for all source qids
-    ids = {}
-    found_id = False
-    for qid in source_list:
-        # See where all the qids map.
-        # If unmapped, map it to this id.
-        # If mapped, check for conflict.
-        other_id = equivalences.get(qid)
-        if other_id != None:
-            if other_id == id:
-                found_id = True
-            else:
-                ids[other_id] = qid
-        equivalences[qid] = id
-    n = len(ids)
-    if n == 0: return
-    qidstuff = ';'.join(map((lambda qid: '%s:%s' % qid), ids.values()))
-    idstuff = ';'.join(map(str, ids.keys()))
-    if found_id:
-        mode = 'merge_in'
-    else:
+# Updates equivalences for all source qids of every row of a version
+# (idtables.Rows), in order.  Most rows have a single source qid, and
+# those skip the ids dict unless there's a conflict.
+
+def check_source_lists(rows, equivalences, changes, coder):
+    get = equivalences.get
+    note_change = equivalence_shards.note_change
+    keys = rows.keys
+    pos = 0
+    for (id, n) in itertools.izip(rows.uids, rows.counts):
         if n == 1:
-            mode = 'change_id'
+            key = keys[pos]
+            other_id = get(key)
+            equivalences[key] = id
+            if other_id != None and other_id != id:
+                note_change(id, {other_id: key}, False, changes, coder)
         else:
-            mode = 'form_new'
-    changes.append((id, qidstuff, idstuff, mode))
-    return None
+            ids = {}
+            found_id = False
+            for i in xrange(pos, pos + n):
+                key = keys[i]
+                # See where all the qids map.
+                # If unmapped, map it to this id.
+                # If mapped, check for conflict.
+                other_id = get(key)
+                if other_id != None:
+                    if other_id == id:
+                        found_id = True
+                    else:
+                        ids[other_id] = key
+                equivalences[key] = id
+            note_change(id, ids, found_id, changes, coder)
+        pos += n
 
 def write_changes(changes, outpath):
     with open(outpath, 'w') as outfile:
@@ -135,7 +199,11 @@ def write_changes(changes, outpath):
 
 # the tarball filename is used as a key in the version registry (for getting id)
 
-def get_taxonomy_path(ott_version):
+# Returns an open file for the version's taxonomy.tsv, or None.  Reads
+# from the unpacked tarball if there is one, otherwise straight out of
+# the tarball, using its index (see recap/tgzindex.py).
+
+def open_taxonomy(ott_version):
     resource_name = 'ott'
     rmeta = recapreg.get_resource(resource_name)
     path = os.path.join('../files.opentreeoflife.org', recap.registry.get_capture_path(ott_version, rmeta))
@@ -155,31 +223,50 @@ def get_taxonomy_path(ott_version):
     elif os.path.isdir(unpack2):
         unpack = unpack2
     else:
-        print '** need to unpack', path
-        print '(cd %s; tar xzvf %s)' % (vdir, tarball)
-        return None
+        return open_taxonomy_in_tarball(path)
 
     tpath = os.path.join(unpack, 'taxonomy')
     if os.path.exists(tpath):
-        return tpath
+        print 'reading', tpath
+        return open(tpath, 'r')
     else:
         tpath = os.path.join(unpack, 'taxonomy.tsv')
         if os.path.exists(tpath):
-            return tpath
+            print 'reading', tpath
+            return open(tpath, 'r')
         else:
             print '** cannot find', tpath
             return None
 
-    return tpath
+def open_taxonomy_in_tarball(path):
+    index = recap.tgzindex.load_index(path)
+    # e.g. ott2.9/taxonomy.tsv; the top level directory varies
+    for name in recap.tgzindex.member_names(index):
+        parts = name.split('/')
+        if len(parts) == 2 and parts[1] in ('taxonomy.tsv', 'taxonomy'):
+            print 'reading', path, name
+            return recap.tgzindex.open_member(path, name, index)
+    print '** no taxonomy in', path
+    return None
 
-def write_registry(registry, outpath):
+def write_registry(registry, ids, coder, outpath):
     with open(outpath, 'w') as outfile:
         print 'writing', outpath
         writer = csv.writer(outfile)
         writer.writerow(('id', 'idspace', 'id_in_idspace', 'capture'))
-        items = registry.items()
-        items.sort(key=lambda(id,record):id)
-        for (id, ((idspace, qu_id), capture)) in items:
-            writer.writerow((id, idspace, qu_id, capture))
+        qids = registry.qids
+        captures = registry.captures
+        capture_names = registry.capture_names
+        decode = coder.decode
+        writer.writerows((id,) + decode(qids[id]) + (capture_names[captures[id]],)
+                         for id in sorted(ids))
 
-process_registry(int(sys.argv[1]), int(sys.argv[2]))
+# python construct_ottid_registry.py start count [jobs [shards]]
+if __name__ == '__main__':
+    jobs = None
+    shards = None
+    if len(sys.argv) > 3:
+        jobs = int(sys.argv[3])
+    if len(sys.argv) > 4:
+        shards = int(sys.argv[4])
+    process_registry(int(sys.argv[1]), int(sys.argv[2]), jobs, shards)
@@ -0,0 +1,190 @@
+# The qid -> OTT id equivalences of construct_ottid_registry, split
+# among long-lived worker processes.
+
+# Within one OTT version, what check_source_lists does with a qid depends
+# only on earlier updates to that same qid.  So the equivalences can be
+# partitioned by qid (see idtables.key_shard), and each shard can go
+# through its own qids of a version by itself, looking them up and
+# updating them in row order.  The parse workers have already split
+# each version's keys by shard (idtables.Rows.partition), so a shard
+# only loops over its own share.  It reports the rows in which one of
+# its qids was already mapped to the row's OTT id ('found'), and each
+# of its qids that was mapped to some other id.  The main process then
+# goes through just the rows that had other ids, in order, and makes
+# the same change records check_source_lists would have, adding to the
+# ids dict in key order so that it comes out the same.
+
+# Protocol: the main process sends (command, ...) tuples, and big
+# arrays as raw bytes after them.
+#   ('load', path)   take this shard's equivalences from a state file
+#   ('update', rows) then the row numbers and key positions of this
+#                    shard's keys, and all of the version's keys and
+#                    uids (see idtables.Rows);
+#                    reply: found flags by row, then other-id records
+#   ('dump',)        reply: keys, then OTT ids
+#   ('stop',)
+
+import array, itertools, multiprocessing
+import idtables
+
+class ShardedEquivalences:
+    def __init__(self, shards):
+        self.shards = shards
+        self.conns = []
+        self.processes = []
+        for shard in xrange(shards):
+            (conn, child_conn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve, args=(child_conn, shard, shards))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    # Start with the equivalences saved in a state file (see
+    # idtables.save_state)
+    def load(self, path):
+        for conn in self.conns:
+            conn.send(('load', path))
+        for conn in self.conns:
+            conn.recv()
+
+    # Process one version's rows (idtables.Rows), appending change
+    # records to changes just as check_source_lists does.  Split in two
+    # so that the caller can do other things while the shards work.
+    def start_update(self, rows):
+        keys = rows.keys.tostring()
+        uids = rows.uids.tostring()
+        for (shard, conn) in enumerate(self.conns):
+            conn.send(('update', len(rows.uids)))
+            conn.send_bytes(rows.shard_rows[shard].tostring())
+            conn.send_bytes(rows.shard_positions[shard].tostring())
+            conn.send_bytes(keys)
+            conn.send_bytes(uids)
+
+    def finish_update(self, rows, changes, coder):
+        founds = []
+        others = {}             # row number -> [(key position, other OTT id)]
+        for conn in self.conns:
+            founds.append(conn.recv_bytes())
+            records = receive_array(conn, 'l')
+            for (row, pos, other_id) in itertools.izip(records[0::3], records[1::3], records[2::3]):
+                mapped = others.get(row)
+                if mapped == None:
+                    others[row] = [(pos, other_id)]
+                else:
+                    mapped.append((pos, other_id))
+        keys = rows.keys
+        uids = rows.uids
+        for row in sorted(others):
+            mapped = others[row]
+            if len(mapped) > 1:
+                mapped.sort()
+            ids = {}
+            for (pos, other_id) in mapped:
+                ids[other_id] = keys[pos]
+            found_id = False
+            for found in founds:
+                if found[row] != '\x00':
+                    found_id = True
+                    break
+            note_change(uids[row], ids, found_id, changes, coder)
+
+    # For idtables.save_state: (an array of keys from each shard, and
+    # an array of the OTT ids they map to)
+    def items(self):
+        for conn in self.conns:
+            conn.send(('dump',))
+        keys = []
+        values = []
+        for conn in self.conns:
+            keys.append(receive_array(conn, 'l'))
+            values.append(receive_array(conn, 'l'))
+        return (keys, values)
+
+    def stop(self):
+        for conn in self.conns:
+            try:
+                conn.send(('stop',))
+            except IOError:
+                pass            # already gone
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+# The same as the end of check_source_lists (construct_ottid_registry
+# uses this one)
+
+def note_change(id, ids, found_id, changes, coder):
+    n = len(ids)
+    if n == 0: return
+    qidstuff = ';'.join(map((lambda key: '%s:%s' % coder.decode(key)), ids.values()))
+    idstuff = ';'.join(map(str, ids.keys()))
+    if found_id:
+        mode = 'merge_in'
+    else:
+        if n == 1:
+            mode = 'change_id'
+        else:
+            mode = 'form_new'
+    changes.append((id, qidstuff, idstuff, mode))
+
+def receive_array(conn, typecode):
+    a = array.array(typecode)
+    a.fromstring(conn.recv_bytes())
+    return a
+
+# Runs in a shard process
+
+def serve(conn, shard, shards):
+    equivalences = {}
+    while True:
+        message = conn.recv()
+        command = message[0]
+        if command == 'load':
+            path = message[1]
+            with open(path, 'rb') as infile:
+                string_shards = idtables.string_shards(idtables.read_header(infile)['strings'], shards)
+            key_shard = idtables.key_shard
+            (keys, values) = idtables.load_equivalences(path)
+            for (key, value) in itertools.izip(keys, values):
+                if key_shard(key, string_shards, shards) == shard:
+                    equivalences[key] = value
+            del keys, values
+            conn.send(len(equivalences))
+        elif command == 'update':
+            rows = receive_array(conn, 'l')
+            positions = receive_array(conn, 'l')
+            keys = receive_array(conn, 'l')
+            uids = receive_array(conn, 'l')
+            (found, records) = update(equivalences, message[1], rows, positions, keys, uids)
+            conn.send_bytes(str(found))
+            conn.send_bytes(records.tostring())
+        elif command == 'dump':
+            conn.send_bytes(array.array('l', equivalences.iterkeys()).tostring())
+            conn.send_bytes(array.array('l', equivalences.itervalues()).tostring())
+        elif command == 'stop':
+            conn.close()
+            return
+
+# The first half of check_source_lists, for this shard's qids: those at
+# positions in keys, in rows (both in order).  Returns found (a flag
+# for each of the version's nrows rows: one of our qids was already
+# mapped to the row's id) and (row, key position, other id) for each
+# qid that was mapped to some other id, all in one array.
+
+def update(equivalences, nrows, rows, positions, keys, uids):
+    get = equivalences.get
+    found = bytearray(nrows)
+    records = array.array('l')
+    for (row, pos) in itertools.izip(rows, positions):
+        key = keys[pos]
+        id = uids[row]
+        other_id = get(key)
+        if other_id != None:
+            if other_id == id:
+                found[row] = 1
+            else:
+                records.extend((row, pos, other_id))
+        equivalences[key] = id
+    return (found, records)
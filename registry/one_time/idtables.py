@@ -0,0 +1,394 @@
+# Compact tables for construct_ottid_registry.
+
+# Replaying all the OTT versions builds up millions of registrations
+# and qid equivalences.  Held as dicts of tuples of strings, each one
+# costs a couple of hundred bytes; here they are small integers.
+
+# A qid (idspace, id) is packed into one int:
+#   (id << code_bits) | (idspace code << 1) | 0    numeric id
+#   (n << code_bits) | (idspace code << 1) | 1     n-th non-numeric id
+# Idspaces are numbered in order of first appearance.  Most source
+# ids (NCBI, GBIF, IRMNG, ...) are numbers; the others (e.g. SILVA
+# accessions) are kept once each in a string table.  The packed ints
+# fit in a machine word, so a dict keyed by them is all that the
+# equivalences need.
+
+# The registry (OTT id -> (qid, capture)) is a pair of arrays indexed
+# directly by OTT id, since OTT ids are fairly dense.
+
+import array, struct, itertools, zlib, cPickle
+import recap.fileutil
+
+code_bits = 20
+max_codes = 1 << (code_bits - 1)
+max_digits = 12                 # so that id << code_bits fits in 63 bits
+no_qid = -1
+
+class QidCoder:
+    def __init__(self):
+        self.idspaces = []          # code -> idspace
+        self.idspace_tags = {}      # idspace -> code << 1
+        self.strings = []           # n -> non-numeric id
+        self.string_numbers = {}    # non-numeric id -> n
+
+    def idspace_tag(self, idspace):
+        tag = self.idspace_tags.get(idspace)
+        if tag == None:
+            code = len(self.idspaces)
+            if code >= max_codes:
+                raise ValueError('too many idspaces')
+            self.idspaces.append(idspace)
+            tag = code << 1
+            self.idspace_tags[idspace] = tag
+        return tag
+
+    # One qid; see Rows.add_all for a whole taxonomy's worth
+    def encode(self, qid):
+        (idspace, id) = qid
+        tag = self.idspace_tag(idspace)
+        if is_number(id):
+            return (int(id) << code_bits) | tag
+        else:
+            return (self.string_number(id) << code_bits) | tag | 1
+
+    def idspace(self, key):
+        return self.idspaces[(key >> 1) & (max_codes - 1)]
+
+    # Re-encode keys (an array, changed in place) made by another coder,
+    # whose tables are idspaces and strings.  string_positions says
+    # which keys have non-numeric ids.
+    def translate(self, keys, idspaces, strings, string_positions):
+        tags = [self.idspace_tag(idspace) for idspace in idspaces]
+        if tags != [code << 1 for code in xrange(len(tags))]:
+            tag_mask = (max_codes - 1) << 1
+            keys[:] = array.array('l', [(key & ~tag_mask) | tags[(key >> 1) & (max_codes - 1)]
+                                        for key in keys])
+        low_mask = (1 << code_bits) - 1
+        for i in string_positions:
+            key = keys[i]
+            n = self.string_number(strings[key >> code_bits])
+            keys[i] = (n << code_bits) | (key & low_mask)
+
+    def string_number(self, id):
+        n = self.string_numbers.get(id)
+        if n == None:
+            n = len(self.strings)
+            self.strings.append(id)
+            self.string_numbers[id] = n
+        return n
+
+    def decode(self, key):
+        idspace = self.idspaces[(key >> 1) & (max_codes - 1)]
+        if key & 1:
+            return (idspace, self.strings[key >> code_bits])
+        else:
+            return (idspace, str(key >> code_bits))
+
+def is_number(id):
+    return id.isdigit() and id[0] != '0' and len(id) <= max_digits
+
+# Which of shards processes keeps the equivalence for a key (see
+# equivalence_shards.py).  This goes by the qid's id, not by the whole
+# key, since a non-numeric id's number depends on the order a coder
+# happened to see it in; string_shards is the shard of each of the
+# coder's strings (see string_shards).
+
+def key_shard(key, string_shards, shards):
+    if key & 1:
+        return string_shards[key >> code_bits]
+    else:
+        return (key >> code_bits) % shards
+
+def string_shards(strings, shards):
+    return [(zlib.crc32(id) & 0xffffffff) % shards for id in strings]
+
+# OTT id -> (packed qid, capture name)
+
+class IdTable:
+    def __init__(self):
+        self.qids = array.array('l')        # by OTT id; no_qid if unregistered
+        self.captures = array.array('H')    # by OTT id; index into capture_names
+        self.capture_names = []
+        self.capture_codes = {}
+        self.count = 0
+        self.end = 0                        # highest registered OTT id + 1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        return id < len(self.qids) and self.qids[id] != no_qid
+
+    def get(self, id):
+        if id < len(self.qids):
+            key = self.qids[id]
+            if key != no_qid:
+                return (key, self.capture_names[self.captures[id]])
+        return None
+
+    def put(self, id, key, capture):
+        if id >= len(self.qids):
+            more = max(id + 1, 2 * len(self.qids)) - len(self.qids)
+            self.qids.extend(array.array('l', [no_qid]) * more)
+            self.captures.extend(array.array('H', [0]) * more)
+        if self.qids[id] == no_qid:
+            self.count += 1
+            self.end = max(self.end, id + 1)
+        self.qids[id] = key
+        self.captures[id] = self.capture_code(capture)
+
+    # Registers each id in ids that isn't registered yet, with its key
+    # in keys and the capture that capture_of(idspace) gives for the
+    # key's idspace.  Returns the ids registered, in order.  (Like put,
+    # for a whole OTT version at once.)
+    def register_new(self, ids, keys, coder, capture_of):
+        if len(ids) == 0:
+            return []
+        top = max(ids) + 1
+        if top > len(self.qids):
+            more = max(top, 2 * len(self.qids)) - len(self.qids)
+            self.qids.extend(array.array('l', [no_qid]) * more)
+            self.captures.extend(array.array('H', [0]) * more)
+        qids = self.qids
+        captures = self.captures
+        tag_mask = (max_codes - 1) << 1
+        codes = {}                  # idspace tag -> capture code
+        novel = []
+        for (id, key) in itertools.izip(ids, keys):
+            if qids[id] == no_qid:
+                tag = key & tag_mask
+                code = codes.get(tag)
+                if code == None:
+                    code = self.capture_code(capture_of(coder.idspace(key)))
+                    codes[tag] = code
+                qids[id] = key
+                captures[id] = code
+                novel.append(id)
+        if novel:
+            self.count += len(novel)
+            self.end = max(self.end, max(novel) + 1)
+        return novel
+
+    def capture_code(self, capture):
+        code = self.capture_codes.get(capture)
+        if code == None:
+            code = len(self.capture_names)
+            self.capture_names.append(capture)
+            self.capture_codes[capture] = code
+        return code
+
+    # Registered OTT ids, in order
+    def ids(self):
+        qids = self.qids
+        return [id for id in xrange(self.end) if qids[id] != no_qid]
+
+# Saving the state of a registry run (see construct_ottid_registry's
+# checkpoints).  The file is a small pickled header (the idspace and
+# string tables, capture names, and array lengths), then the registry
+# arrays, then the equivalences as two arrays, keys and the OTT ids
+# they map to, in no particular order (sorting them at every checkpoint
+# would cost more than writing them; ottid_index sorts them once).
+# Arrays are written and read directly, without going through pickle,
+# and the equivalences a chunk at a time, so saving takes little memory
+# beyond the tables themselves.
+
+chunk_size = 1 << 20
+
+def save_state(path, name, registry, equivalences, coder):
+    if isinstance(equivalences, dict):
+        count = len(equivalences)
+        keys = chunks(equivalences.iterkeys())
+        values = chunks(equivalences.itervalues())
+    else:
+        # equivalence_shards.ShardedEquivalences
+        (keys, values) = equivalences.items()
+        count = sum(len(chunk) for chunk in keys)
+    header = {'name': name,
+              'count': registry.count,
+              'capture_names': registry.capture_names,
+              'idspaces': coder.idspaces,
+              'strings': coder.strings,
+              'ids': registry.end,
+              'equivalences': count}
+    with recap.fileutil.atomic_write(path) as outfile:
+        blob = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL)
+        outfile.write(struct.pack('<Q', len(blob)))
+        outfile.write(blob)
+        registry.qids[0:registry.end].tofile(outfile)
+        registry.captures[0:registry.end].tofile(outfile)
+        for chunk in keys:
+            chunk.tofile(outfile)
+        for chunk in values:
+            chunk.tofile(outfile)
+
+def chunks(iterator):
+    while True:
+        chunk = array.array('l', itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# Returns (name, registry, equivalences, coder).  equivalences is None
+# if with_equivalences is false (see load_equivalences).
+
+def load_state(path, with_equivalences=True):
+    with open(path, 'rb') as infile:
+        header = read_header(infile)
+        registry = IdTable()
+        registry.qids.fromfile(infile, header['ids'])
+        registry.captures.fromfile(infile, header['ids'])
+    registry.count = header['count']
+    registry.end = header['ids']
+    registry.capture_names = header['capture_names']
+    registry.capture_codes = dict(zip(registry.capture_names, xrange(len(registry.capture_names))))
+    equivalences = None
+    if with_equivalences:
+        (keys, values) = load_equivalences(path)
+        equivalences = dict(itertools.izip(keys, values))
+    coder = QidCoder()
+    coder.idspaces = header['idspaces']
+    coder.strings = header['strings']
+    coder.idspace_tags = dict(zip(coder.idspaces, [code << 1 for code in xrange(len(coder.idspaces))]))
+    coder.string_numbers = dict(zip(coder.strings, xrange(len(coder.strings))))
+    return (header['name'], registry, equivalences, coder)
+
+# Just the equivalences from a state file: (keys, OTT ids), two arrays,
+# in the order they were saved
+
+def load_equivalences(path):
+    with open(path, 'rb') as infile:
+        header = read_header(infile)
+        # Skip the registry arrays
+        infile.seek(header['ids'] * (array.array('l').itemsize + array.array('H').itemsize), 1)
+        keys = array.array('l')
+        keys.fromfile(infile, header['equivalences'])
+        values = array.array('l')
+        values.fromfile(infile, header['equivalences'])
+    return (keys, values)
+
+def read_header(infile):
+    (size,) = struct.unpack('<Q', infile.read(8))
+    return cPickle.loads(infile.read(size))
+
+# One OTT version's taxonomy, parsed and encoded (by a QidCoder of its
+# own): for each row the uid and the number of qids, and all the qids'
+# keys in one array, along with the coder's tables.  Same layout as
+# the state files.
+
+class Rows:
+    def __init__(self):
+        self.uids = array.array('l')
+        self.counts = array.array('H')
+        self.keys = array.array('l')
+        self.string_positions = array.array('l')    # indexes in keys of non-numeric ids
+        self.coder = QidCoder()
+        # With shards, for each shard the row number and position in
+        # keys of each of its keys (see partition)
+        self.shard_rows = []
+        self.shard_positions = []
+
+    # Adds (uid, [qid, ...]) rows, as from a TaxonomyReader.  Encoding
+    # is done here, all in one loop, since it's done millions of times
+    # per version; this is QidCoder.encode with everything it looks at
+    # held in local variables.
+    def add_all(self, source):
+        coder = self.coder
+        tags = coder.idspace_tags
+        numbers = coder.string_numbers
+        strings = coder.strings
+        add_uid = self.uids.append
+        add_count = self.counts.append
+        keys = self.keys
+        add_key = keys.append
+        add_string_position = self.string_positions.append
+        for (uid, qids) in source:
+            add_uid(uid)
+            add_count(len(qids))
+            for (idspace, id) in qids:
+                try:
+                    tag = tags[idspace]
+                except KeyError:
+                    tag = coder.idspace_tag(idspace)
+                if id.isdigit() and id[0] != '0' and len(id) <= max_digits:
+                    add_key((int(id) << code_bits) | tag)
+                else:
+                    n = numbers.get(id)
+                    if n == None:
+                        n = len(strings)
+                        strings.append(id)
+                        numbers[id] = n
+                    add_string_position(len(keys))
+                    add_key((n << code_bits) | tag | 1)
+
+    # Splits the keys among shards, as equivalence_shards does, so that
+    # each shard process can be sent just its own.  Done in the parse
+    # workers rather than in the main process.
+    def partition(self, shards):
+        shard_of = string_shards(self.coder.strings, shards)
+        self.shard_rows = [array.array('l') for shard in xrange(shards)]
+        self.shard_positions = [array.array('l') for shard in xrange(shards)]
+        add_rows = [a.append for a in self.shard_rows]
+        add_positions = [a.append for a in self.shard_positions]
+        keys = self.keys
+        pos = 0
+        for (row, n) in enumerate(self.counts):
+            for i in xrange(pos, pos + n):
+                key = keys[i]
+                if key & 1:
+                    shard = shard_of[key >> code_bits]
+                else:
+                    shard = (key >> code_bits) % shards
+                add_rows[shard](row)
+                add_positions[shard](i)
+            pos += n
+
+    # The first key of each row
+    def first_keys(self):
+        keys = self.keys
+        firsts = array.array('l')
+        add = firsts.append
+        pos = 0
+        for n in self.counts:
+            add(keys[pos])
+            pos += n
+        return firsts
+
+def save_rows(path, rows):
+    header = {'idspaces': rows.coder.idspaces,
+              'strings': rows.coder.strings,
+              'rows': len(rows.uids),
+              'keys': len(rows.keys),
+              'string_positions': len(rows.string_positions),
+              'shard_sizes': [len(a) for a in rows.shard_positions]}
+    with recap.fileutil.atomic_write(path) as outfile:
+        blob = cPickle.dumps(header, cPickle.HIGHEST_PROTOCOL)
+        outfile.write(struct.pack('<Q', len(blob)))
+        outfile.write(blob)
+        rows.uids.tofile(outfile)
+        rows.counts.tofile(outfile)
+        rows.keys.tofile(outfile)
+        rows.string_positions.tofile(outfile)
+        for (shard_rows, shard_positions) in zip(rows.shard_rows, rows.shard_positions):
+            shard_rows.tofile(outfile)
+            shard_positions.tofile(outfile)
+
+# Returns Rows, with keys translated to coder's encoding
+
+def load_rows(path, coder):
+    rows = Rows()
+    with open(path, 'rb') as infile:
+        header = read_header(infile)
+        rows.uids.fromfile(infile, header['rows'])
+        rows.counts.fromfile(infile, header['rows'])
+        rows.keys.fromfile(infile, header['keys'])
+        rows.string_positions.fromfile(infile, header['string_positions'])
+        for size in header['shard_sizes']:
+            shard_rows = array.array('l')
+            shard_rows.fromfile(infile, size)
+            rows.shard_rows.append(shard_rows)
+            shard_positions = array.array('l')
+            shard_positions.fromfile(infile, size)
+            rows.shard_positions.append(shard_positions)
+    coder.translate(rows.keys, header['idspaces'], header['strings'], rows.string_positions)
+    rows.coder = coder
+    return rows
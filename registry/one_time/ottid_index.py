@@ -0,0 +1,288 @@
+# Looking up OTT ids and source qids without going through the
+# per-version CSVs.
+
+# The index is built from a construct_ottid_registry state file (see
+# idtables.save_state) and answers two questions:
+#   OTT id -> (idspace, id in idspace, capture)   where the id came from
+#   qid -> OTT id       what the qid was last mapped to (the equivalences)
+# It is a single file meant to be mmapped, so that opening it costs
+# next to nothing and a lookup touches only a few pages:
+
+#   8 bytes       length of the pickled header
+#   header        idspaces, capture names, where each array starts,
+#                 and every block_size'th non-numeric id in sorted order
+#   qids          packed qid by OTT id, or no_qid   (array 'l')
+#   captures      capture number by OTT id          (array 'H')
+#   keys          packed qids, sorted               (array 'l')
+#   values        OTT id for each key               (array 'l')
+#   key_fence     every block_size'th key           (array 'l')
+#   string_offsets  start of each non-numeric id in string_data, and
+#                 its end                           (array 'l')
+#   string_order  string numbers, sorted by string  (array 'l')
+#   string_data   the non-numeric ids, concatenated
+
+# Arrays start on 8 byte boundaries and are in the machine's byte
+# order.  Qids are packed as in idtables.QidCoder.  An OTT id is looked
+# up by indexing qids directly.  A qid is looked up by binary search,
+# first in the key fence, which is read into memory when the index is
+# opened, then in the one block of keys that it points to (and, for a
+# non-numeric id, first the same way in the sorted strings).  Batch
+# lookups go in sorted order, so that consecutive qids mostly find
+# their block already read.
+
+# python ottid_index.py build state.pickle index
+# python ottid_index.py id index [ott id ...]
+# python ottid_index.py qid index [idspace:id ...]
+# With no ids on the command line, reads them from stdin, one per line.
+
+import sys, csv, mmap, array, struct, bisect, cPickle
+import recap.fileutil
+import idtables
+
+alignment = 8
+block_size = 256
+
+def build(state_path, index_path):
+    with open(state_path, 'rb') as infile:
+        header = idtables.read_header(infile)
+        qids = array.array('l')
+        qids.fromfile(infile, header['ids'])
+        captures = array.array('H')
+        captures.fromfile(infile, header['ids'])
+    (keys, values) = idtables.load_equivalences(state_path)
+    # State files don't keep them sorted
+    order = sorted(xrange(len(keys)), key=keys.__getitem__)
+    keys = array.array('l', [keys[i] for i in order])
+    values = array.array('l', [values[i] for i in order])
+    del order
+    strings = header['strings']
+    string_offsets = array.array('l', [0])
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+    string_order = array.array('l', sorted(xrange(len(strings)), key=strings.__getitem__))
+    string_fence = [strings[n] for n in string_order[::block_size]]
+    sections = [('qids', qids),
+                ('captures', captures),
+                ('keys', keys),
+                ('values', values),
+                ('key_fence', keys[::block_size]),
+                ('string_offsets', string_offsets),
+                ('string_order', string_order),
+                ('string_data', ''.join(strings))]
+    index_header = {'name': header['name'],
+                    'idspaces': header['idspaces'],
+                    'capture_names': header['capture_names'],
+                    'string_fence': string_fence,
+                    'sections': {}}
+    # The header holds the arrays' offsets, so its length depends on
+    # them.  Lay the arrays out from 0, then move them all past the
+    # header, leaving room for the offsets taking a few more bytes.
+    position = 0
+    for (name, data) in sections:
+        position = align(position)
+        index_header['sections'][name] = [position, len(data)]
+        position += nbytes(data)
+    blob = cPickle.dumps(index_header, cPickle.HIGHEST_PROTOCOL)
+    base = align(8 + len(blob) + 64)
+    for name in index_header['sections']:
+        index_header['sections'][name][0] += base
+    blob = cPickle.dumps(index_header, cPickle.HIGHEST_PROTOCOL)
+    assert 8 + len(blob) <= base
+    with recap.fileutil.atomic_write(index_path) as outfile:
+        outfile.write(struct.pack('<Q', len(blob)))
+        outfile.write(blob)
+        for (name, data) in sections:
+            outfile.write('\0' * (index_header['sections'][name][0] - outfile.tell()))
+            if isinstance(data, array.array):
+                data.tofile(outfile)
+            else:
+                outfile.write(data)
+    return (header['count'], len(keys))
+
+def align(n):
+    return (n + alignment - 1) // alignment * alignment
+
+def nbytes(data):
+    if isinstance(data, array.array):
+        return len(data) * data.itemsize
+    return len(data)
+
+# A read-only array in the mmapped file, usable with bisect
+
+class MappedArray:
+    def __init__(self, buf, section, typecode):
+        (self.offset, self.length) = section
+        self.buf = buf
+        self.item = struct.Struct(typecode)
+        self.itemsize = self.item.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.length:
+            raise IndexError(i)
+        return self.item.unpack_from(self.buf, self.offset + i * self.itemsize)[0]
+
+# The non-numeric ids in sorted order, also for bisect
+
+class SortedStrings:
+    def __init__(self, index):
+        self.index = index
+        self.order = index.string_order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.index.string(self.order[i])
+
+class OttIdIndex:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (size,) = struct.unpack_from('<Q', self.buf, 0)
+        header = cPickle.loads(self.buf[8:8 + size])
+        sections = header['sections']
+        self.sections = sections
+        self.name = header['name']
+        self.idspaces = header['idspaces']
+        self.idspace_tags = dict(zip(self.idspaces, [code << 1 for code in xrange(len(self.idspaces))]))
+        self.capture_names = header['capture_names']
+        self.qids = MappedArray(self.buf, sections['qids'], 'l')
+        self.captures = MappedArray(self.buf, sections['captures'], 'H')
+        self.keys = MappedArray(self.buf, sections['keys'], 'l')
+        self.values = MappedArray(self.buf, sections['values'], 'l')
+        self.key_fence = self.read_array(sections['key_fence'], 'l')
+        self.block_number = None    # the block of keys last read
+        self.block = None
+        self.string_offsets = MappedArray(self.buf, sections['string_offsets'], 'l')
+        self.string_order = MappedArray(self.buf, sections['string_order'], 'l')
+        self.string_data = sections['string_data'][0]
+        self.sorted_strings = SortedStrings(self)
+        self.string_fence = header['string_fence']
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_array(self, section, typecode, start=0, end=None):
+        (offset, length) = section
+        if end == None or end > length:
+            end = length
+        a = array.array(typecode)
+        a.fromstring(self.buf[offset + start * a.itemsize:offset + end * a.itemsize])
+        return a
+
+    def string(self, n):
+        start = self.string_data + self.string_offsets[n]
+        return self.buf[start:self.string_data + self.string_offsets[n + 1]]
+
+    # OTT id -> (idspace, id in idspace, capture), or None
+
+    def lookup_id(self, id):
+        if id < 0 or id >= len(self.qids):
+            return None
+        key = self.qids[id]
+        if key == idtables.no_qid:
+            return None
+        return self.decode(key) + (self.capture_names[self.captures[id]],)
+
+    def lookup_ids(self, ids):
+        return [self.lookup_id(id) for id in ids]
+
+    # (idspace, id in idspace) -> OTT id, or None
+
+    def lookup_qid(self, qid):
+        key = self.encode(qid)
+        if key == None:
+            return None
+        return self.find(key)
+
+    # Same, for a list of qids
+
+    def lookup_qids(self, qids):
+        keys = [self.encode(qid) for qid in qids]
+        results = [None] * len(keys)
+        for i in sorted(xrange(len(keys)), key=keys.__getitem__):
+            if keys[i] != None:
+                results[i] = self.find(keys[i])
+        return results
+
+    # OTT id for a packed key, or None
+
+    def find(self, key):
+        b = bisect.bisect_right(self.key_fence, key) - 1
+        if b < 0:
+            return None
+        if b != self.block_number:
+            self.block = self.read_array(self.sections['keys'], 'l',
+                                         b * block_size, (b + 1) * block_size)
+            self.block_number = b
+        i = bisect.bisect_left(self.block, key)
+        if i < len(self.block) and self.block[i] == key:
+            return self.values[b * block_size + i]
+        return None
+
+    # Packed key for qid, as idtables.QidCoder would make it, or None if
+    # nothing in the index could have it
+
+    def encode(self, qid):
+        (idspace, id) = qid
+        tag = self.idspace_tags.get(idspace)
+        if tag == None:
+            return None
+        if id.isdigit() and id[0] != '0' and len(id) <= idtables.max_digits:
+            return (int(id) << idtables.code_bits) | tag
+        b = bisect.bisect_right(self.string_fence, id) - 1
+        if b < 0:
+            return None
+        i = bisect.bisect_left(self.sorted_strings, id, b * block_size,
+                               min((b + 1) * block_size, len(self.sorted_strings)))
+        if i == len(self.sorted_strings) or self.sorted_strings[i] != id:
+            return None
+        return (self.string_order[i] << idtables.code_bits) | tag | 1
+
+    def decode(self, key):
+        idspace = self.idspaces[(key >> 1) & (idtables.max_codes - 1)]
+        if key & 1:
+            return (idspace, self.string(key >> idtables.code_bits))
+        else:
+            return (idspace, str(key >> idtables.code_bits))
+
+def parse_qid(qid):
+    s = qid.split(':', 1)
+    if len(s) < 2:
+        return (s[0], '')
+    return (s[0], s[1])
+
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    if command == 'build':
+        (ids, keys) = build(sys.argv[2], sys.argv[3])
+        print 'indexed', ids, 'OTT ids', keys, 'qids'
+        sys.exit(0)
+    if command not in ('id', 'qid'):
+        print '** unrecognized command', command
+        sys.exit(1)
+    args = sys.argv[3:]
+    if not args:
+        args = [line.strip() for line in sys.stdin if line.strip()]
+    writer = csv.writer(sys.stdout)
+    with OttIdIndex(sys.argv[2]) as index:
+        if command == 'id':
+            for (id, result) in zip(args, index.lookup_ids([int(id) for id in args])):
+                if result == None:
+                    writer.writerow((id, '', '', ''))
+                else:
+                    writer.writerow((id,) + result)
+        else:
+            for (qid, id) in zip(args, index.lookup_qids([parse_qid(qid) for qid in args])):
+                writer.writerow((qid, '' if id == None else id))
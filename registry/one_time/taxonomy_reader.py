@@ -0,0 +1,82 @@
+# Reading just the columns of an OTT taxonomy.tsv that
+# construct_ottid_registry needs.
+
+# A taxonomy has millions of rows, and splitting each one completely on
+# '\t|\t', then splitting every source qid with Python code, is most of
+# the cost of processing an OTT version.  Here each line is split only
+# as far as the last column wanted, and a sourceinfo field is broken
+# into qids by a single regex findall.  Rows come out as small tuples:
+#   (uid, [(idspace, id in idspace), ...])
+# Unusual sourceinfo fields (URLs, qids with no idspace) go the slow
+# way, giving the same qids construct_ottid_registry always made.
+
+import sys, re
+
+sep = '\t|\t'
+qid_pattern = re.compile(r'([^:,]+):([^,]*)')
+
+class TaxonomyReader:
+    def __init__(self, infile):
+        self.infile = infile
+        header = infile.next().split(sep)
+        def get_col(name):
+            if name in header:
+                return header.index(name)
+            else:
+                return None
+        self.uid_col = get_col('uid')
+        self.source_col = get_col('source')
+        self.sourceid_col = get_col('sourceid')
+        self.sourceinfo_col = get_col('sourceinfo')
+        self.name_col = get_col('name')
+        if self.source_col != None:
+            wanted = [self.uid_col, self.source_col, self.sourceid_col]
+        else:
+            wanted = [self.uid_col, self.sourceinfo_col, self.name_col]
+        self.maxsplit = max(wanted) + 1
+
+    def __iter__(self):
+        uid_col = self.uid_col
+        maxsplit = self.maxsplit
+        if self.source_col != None:
+            source_col = self.source_col
+            sourceid_col = self.sourceid_col
+            for line in self.infile:
+                row = line.split(sep, maxsplit)
+                yield (int(row[uid_col]), [(row[source_col], row[sourceid_col])])
+        else:
+            sourceinfo_col = self.sourceinfo_col
+            findall = qid_pattern.findall
+            for line in self.infile:
+                row = line.split(sep, maxsplit)
+                sourceinfo = row[sourceinfo_col]
+                source_list = findall(sourceinfo)
+                if len(source_list) != sourceinfo.count(',') + 1 or 'http' in sourceinfo:
+                    source_list = self.parse_sourceinfo(sourceinfo, row, line)
+                yield (int(row[uid_col]), source_list)
+
+    def parse_sourceinfo(self, sourceinfo, row, line):
+        source_list = []
+        for qid in sourceinfo.split(','):
+            if qid.startswith('http'):
+                source_list.append((qid, row[self.name_col]))
+            else:
+                s = qid.split(':', 1)
+                if len(s) > 1:
+                    source_list.append((s[0], s[1]))
+                else:
+                    print line.split(sep)
+                    source_list.append((s[0], row[self.name_col]))
+        return source_list
+
+
+if __name__ == '__main__':
+    # python taxonomy_reader.py taxonomy.tsv - count rows and idspaces
+    with open(sys.argv[1], 'rb') as infile:
+        idspaces = {}
+        count = 0
+        for (uid, source_list) in TaxonomyReader(infile):
+            for (idspace, id) in source_list:
+                idspaces[idspace] = True
+            count += 1
+        print count, 'rows', len(idspaces), 'idspaces'